@@ -1,4 +1,5 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, Header
+from fastapi.responses import PlainTextResponse, StreamingResponse
 #WebSocket creates real-time connections (not normal HTTP)
 #WebSocketDisconnects is a special exception fastAPI throws when a WebSocket disconnects (someone closes the tab)
 #HTTPException can throw custom errors
@@ -11,15 +12,43 @@ from fastapi.middleware.cors import CORSMiddleware
 
 import sqlite3
 import uuid
+import os
+import json
+import asyncio
+import threading
+import time
+import bisect
+import queue
+import atexit
+import logging
+import logging.handlers
+import base64
+import hashlib
+import hmac
+import signal
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager
 
 #helps say what types variables should be
 #variables can change types anytime, so this is to prevent that
 from typing import Dict
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 
 #validates and defines the expected shape of incoming data
 from pydantic import BaseModel
 
+#optional speed-ups: the server still works without them, it just falls back to the standard json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 class LoginRequest(BaseModel):
     username: str
@@ -38,8 +67,301 @@ class Message(BaseModel):
     content: str
 
 
+#---Settings---
+#where the database file lives
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "user.db")
+#where old messages are moved to (see MessageArchiver), next to the database file unless set
+ARCHIVE_PATH = os.environ.get("ARCHIVE_PATH", os.path.splitext(DATABASE_PATH)[0] + ".archive.db")
+#messages older than this many days are moved out of the messages table into compressed archive segments...
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", "30"))
+#...this many messages of one conversation per segment (the last one of a conversation that went idle can be smaller)...
+ARCHIVE_SEGMENT_SIZE = int(os.environ.get("ARCHIVE_SEGMENT_SIZE", "500"))
+#...by a background job that runs this often, in seconds (0 turns it off)
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", "3600"))
+#most messages the job moves in one transaction, so the writer is never held up for long
+ARCHIVE_CHUNK_SIZE = int(os.environ.get("ARCHIVE_CHUNK_SIZE", "5000"))
+#chat messages are saved in batches: a batch is written when it has this many messages...
+MESSAGE_BATCH_SIZE = int(os.environ.get("MESSAGE_BATCH_SIZE", "100"))
+#...or when its oldest message has waited this many milliseconds, whichever comes first
+MESSAGE_FLUSH_MS = int(os.environ.get("MESSAGE_FLUSH_MS", "50"))
+#"async": the sender does not wait for the disk, a crash can lose the last few milliseconds of messages
+#"sync": the sender waits until the batch holding its message is committed and flushed to disk (safe against power loss too)
+MESSAGE_DURABILITY = os.environ.get("MESSAGE_DURABILITY", "async")
+#most messages that may wait to be saved, senders wait for room beyond this (e.g. while the database is locked)
+MESSAGE_QUEUE_SIZE = int(os.environ.get("MESSAGE_QUEUE_SIZE", "10000"))
+#how many username -> user_id pairs are kept in memory
+IDENTITY_CACHE_SIZE = int(os.environ.get("IDENTITY_CACHE_SIZE", "10000"))
+#how many users' friends and pending requests are kept in memory
+SOCIAL_GRAPH_CACHE_SIZE = int(os.environ.get("SOCIAL_GRAPH_CACHE_SIZE", "10000"))
+#how many rooms' member lists are kept in memory
+ROOM_CACHE_SIZE = int(os.environ.get("ROOM_CACHE_SIZE", "1000"))
+#most members a room can have
+ROOM_MAX_MEMBERS = int(os.environ.get("ROOM_MAX_MEMBERS", "1000"))
+#how many messages one page of chat history holds by default, and at most
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+#how many missed messages one sync page holds by default, and at most
+SYNC_PAGE_SIZE = 200
+SYNC_MAX_PAGE_SIZE = 1000
+#how many search results one page holds by default, and at most
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+#seconds a single WebSocket send may take before that client is treated as dead and dropped
+SEND_TIMEOUT = float(os.environ.get("SEND_TIMEOUT", "5"))
+#how many outgoing frames may wait for one client before SEND_OVERFLOW_POLICY kicks in
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", "256"))
+#what to do when a client's queue is full (see Outbox)
+SEND_OVERFLOW_POLICY = os.environ.get("SEND_OVERFLOW_POLICY", "drop_oldest")
+#friends are told who came online or went offline in batches, collected over this many milliseconds
+PRESENCE_DEBOUNCE_MS = int(os.environ.get("PRESENCE_DEBOUNCE_MS", "250"))
+#typing indicators and read receipts are collected for this many milliseconds, and only the latest one per sender and recipient is sent
+EPHEMERAL_WINDOW_MS = int(os.environ.get("EPHEMERAL_WINDOW_MS", "200"))
+#a typing indicator counts as over after this many seconds, unless the user is still typing (then it is repeated every TYPING_TTL / 2)
+TYPING_TTL = float(os.environ.get("TYPING_TTL", "6"))
+#read receipts are saved to the database (as each user's last read message) this often, in seconds
+READ_CURSOR_SAVE_INTERVAL = float(os.environ.get("READ_CURSOR_SAVE_INTERVAL", "5"))
+#how the server workers (uvicorn --workers N) talk to each other, see make_broker
+#  "local": a single worker, nothing to share (the default)
+#  "unix:///path/to/chat.sock": every worker on this machine joins through a Unix-domain socket
+BROKER_URL = os.environ.get("BROKER_URL", "local")
+#most events a client with a batching wire format gets in a single WebSocket frame
+WS_BATCH_MAX = int(os.environ.get("WS_BATCH_MAX", "64"))
+#a connection that has sent nothing for this many seconds gets a "ping" event, the client answers with "pong"
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "20"))
+#a connection that has sent nothing (not even a "pong") for this many seconds is treated as dead and closed
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", "60"))
+#who is online is kept in memory, and saved to the users.online column only this often (in seconds)
+PRESENCE_SNAPSHOT_INTERVAL = float(os.environ.get("PRESENCE_SNAPSHOT_INTERVAL", "30"))
+#how many processes hash and check passwords, 0 does it on the event loop itself (only useful for benchmarking)
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+#scrypt cost: n is the CPU/memory cost (128 * n * r bytes of memory per hash), r the block size, p the parallelism
+PASSWORD_SCRYPT_N = int(os.environ.get("PASSWORD_SCRYPT_N", str(2 ** 14)))
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+#the admin endpoints (/admin/...) want "Authorization: Bearer <this>", and are turned off while it is empty
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+#DEBUG, INFO, WARNING or ERROR
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+#the same log message is written at most this many times per second (0 turns the limit off)
+LOG_RATE_LIMIT = int(os.environ.get("LOG_RATE_LIMIT", "10"))
+
+
+#---Logging---
+#every log line is one JSON object (time, level, message and whatever fields were passed in "extra")
+#the records are handed to a background thread that does the actual writing, so logging never waits on stderr
+#the same message is logged at most LOG_RATE_LIMIT times per second, the rest are counted and reported with the next one that gets through
+
+#attributes every LogRecord has, anything else on a record came from "extra"
+STANDARD_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in STANDARD_RECORD_FIELDS)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, per_second: int = 10):
+        super().__init__()
+        self.per_second = per_second
+        #message template: [start of the current second, records let through, records dropped]
+        self.windows: Dict[str, list] = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.per_second <= 0:
+            return True
+        now = time.monotonic()
+        #the template, not the formatted text, so "connected for alice" and "connected for bob" count as the same message
+        key = str(record.msg)
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= 1:
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                self.windows[key] = [now, 1, 0]
+                return True
+            if window[1] < self.per_second:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def setup_logging() -> logging.Logger:
+    logger = logging.getLogger("chat")
+    logger.setLevel(LOG_LEVEL)
+    #uvicorn has its own handlers, ours should not print everything twice
+    logger.propagate = False
+    if not logger.handlers:
+        records = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(records)
+        handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT))
+        logger.addHandler(handler)
+        output = logging.StreamHandler()
+        output.setFormatter(JsonFormatter())
+        listener = logging.handlers.QueueListener(records, output)
+        listener.start()
+        #write out whatever is still queued when the process exits
+        atexit.register(listener.stop)
+    return logger
+
+log = setup_logging()
+
+
+#---Metrics---
+#counters, gauges and histograms kept in memory and served by /metrics in the Prometheus text format
+#recording a value is a few dictionary operations, nothing is written anywhere until /metrics is scraped
+#(with several workers, every worker has its own numbers)
+
+#upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+#a number that only goes up, optionally split by labels
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        #label values: count
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+#a value that is read from the running server when /metrics is scraped (e.g. how many connections are open)
+class Sampled:
+    def __init__(self, name: str, help: str, func, kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, "", self.func()
+
+
+#how long something took, counted into buckets so percentiles can be worked out later
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        #label values: [count per bucket (the last one is above every bucket), sum, count]
+        self.series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for label_values, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", format_labels(self.labels, label_values, f'le="{le}"'), cumulative
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def sampled(self, name: str, help: str, func, kind: str = "gauge") -> Sampled:
+        return self.add(Sampled(name, help, func, kind))
+
+    #everything, in the Prometheus text format
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+#the gauges that read the manager and the database are added next to them
+db_query_seconds = metrics.histogram("chat_db_query_seconds", "Time spent on a database method, including waiting for a free connection", ("method",))
+ws_event_seconds = metrics.histogram("chat_ws_event_seconds", "Time spent handling one WebSocket event", ("event",))
+presence_deltas = metrics.counter("chat_presence_deltas_total", "presence_delta events sent to friends")
+ephemeral_received = metrics.counter("chat_ephemeral_events_received_total", "Typing indicators and read receipts received from clients", ("type",))
+ephemeral_forwarded = metrics.counter("chat_ephemeral_events_forwarded_total", "Typing indicators and read receipts sent on after coalescing", ("type",))
+fanout_frames = metrics.counter("chat_fanout_frames_total", "Frames queued by sending one event to several users, one per receiving user", ("event",))
+
+
 #---FastAPI setup---
-app = FastAPI()
+#runs once when the server starts (before "yield") and once when it shuts down (after "yield")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    db.message_writer.start()
+    passwords.start()
+    #join the other workers (if there are any)
+    await manager.start_broker(make_broker(BROKER_URL))
+    manager.start_heartbeat(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+    presence_snapshot.start()
+    archiver.start()
+    ephemeral.start()
+    yield
+    await archiver.stop()
+    await ephemeral.stop()
+    await manager.stop_heartbeat()
+    #save who is still online (on the other workers) before leaving them
+    await presence_snapshot.stop()
+    await manager.stop_broker()
+    #save every message still waiting in the queue, then close the database connections
+    await db.message_writer.stop()
+    passwords.close()
+    db.close()
+
+app = FastAPI(lifespan=lifespan)
 #app holds the entire server (endpoints, websockets, middlewares)
 #any request that is made goes through this app
 
@@ -53,20 +375,544 @@ app.add_middleware(
     allow_headers=["*"], #allow any headers the client sends
 )
 
+#---Passwords---
+#passwords are stored as "scrypt$n$r$p$salt$hash" (salt and hash in base64)
+#scrypt is slow on purpose (tens of milliseconds), so it runs in a pool of processes: hashing on the event loop would freeze every chat socket
+#older rows still hold the plain password, they are replaced by a hash the next time that user logs in
+
+#these two functions run inside the worker processes, so they must stay plain module-level functions
+def hash_password(password: str, n: int = PASSWORD_SCRYPT_N) -> str:
+    salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=PASSWORD_SCRYPT_R, p=PASSWORD_SCRYPT_P, maxmem=256 * n * PASSWORD_SCRYPT_R)
+    return f"scrypt${n}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+#splits a stored hash into (n, r, p, salt, digest), or returns None if it isn't one
+#a plain password can start with "scrypt$" too, so every field is checked before it is treated as a hash
+def parse_password_hash(stored: str):
+    fields = stored.split("$")
+    if len(fields) != 6 or fields[0] != "scrypt":
+        return None
+    try:
+        n, r, p = int(fields[1]), int(fields[2]), int(fields[3])
+        salt = base64.b64decode(fields[4], validate=True)
+        digest = base64.b64decode(fields[5], validate=True)
+    except ValueError:
+        return None
+    #n must be a power of two above 1, or scrypt refuses it
+    if n < 2 or n & (n - 1) or r < 1 or p < 1 or not digest:
+        return None
+    return n, r, p, salt, digest
+
+#returns (whether the password matches, a new hash to store or None)
+#a new hash comes back when the stored one is a plain password or was made with different cost settings
+def check_password(password: str, stored: str, n: int = PASSWORD_SCRYPT_N):
+    parsed = parse_password_hash(stored)
+    if parsed is None:
+        matches = hmac.compare_digest(password.encode(), stored.encode())
+        return matches, hash_password(password, n) if matches else None
+    stored_n, r, p, salt, expected = parsed
+    actual = hashlib.scrypt(password.encode(), salt=salt, n=stored_n, r=r, p=p, maxmem=256 * stored_n * r, dklen=len(expected))
+    if not hmac.compare_digest(actual, expected):
+        return False, None
+    if (stored_n, r, p) != (n, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P):
+        return True, hash_password(password, n)
+    return True, None
+
+
+#runs once in every password process when it starts
+#forked processes inherit uvicorn's signal handlers, which would make them ignore SIGTERM, so the defaults are put back
+#(Ctrl+C reaches the whole process group, but the server shuts the pool down itself)
+#and if the server dies without shutting the pool down (e.g. kill -9), the process exits instead of waiting for work forever
+def password_worker_started(server_pid: int):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def watch_server():
+        while os.getppid() == server_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch_server, daemon=True).start()
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = 4):
+        self.workers = workers
+        self.executor = None
+
+    #the processes are started with the server, not when this module is imported
+    def start(self):
+        if self.executor is None and self.workers > 0:
+            self.executor = ProcessPoolExecutor(self.workers, initializer=password_worker_started, initargs=(os.getpid(),))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    async def run(self, func, *args):
+        if self.workers <= 0:
+            return func(*args)
+        self.start()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_password, password)
+
+    async def check(self, password: str, stored: str):
+        return await self.run(check_password, password, stored)
+
+passwords = PasswordHasher(PASSWORD_HASH_WORKERS)
+
+
 #---Database---
+#sqlite3 calls are blocking: while a query runs, python cannot do anything else
+#if we ran them straight inside an async function, one slow query would freeze every WebSocket on the server
+#the pool runs every query on a background thread instead, and the async code just awaits the result
+class ConnectionPool:
+    def __init__(self, path: str, readers: int = 4, archive_path: str = None):
+        self.path = path
+        #attached to every connection as "archive", so queries can read both files
+        self.archive_path = archive_path
+        #every connection ever opened, so they can all be closed on shutdown
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        #each thread keeps its own connection in here, so a connection is never used by two threads at once
+        self.local = threading.local()
+        #sqlite only allows one writer at a time anyway, so all writes go through a single thread (and a single connection)
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        #reads can run side by side, but only up to "readers" of them (one connection per reader thread)
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        #number of write transactions committed so far (only the writer thread changes it)
+        self.commits = 0
+
+    #returns the connection that belongs to the current thread, opening it the first time
+    def get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            #"check_same_thread" is only turned off so that close() can close it from the main thread
+            connection = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            #WAL (write-ahead logging) lets readers keep reading while the writer is in the middle of a write
+            connection.execute("PRAGMA journal_mode=WAL")
+            #in WAL mode this is still safe after a crash, and it avoids an fsync on every single commit
+            connection.execute("PRAGMA synchronous=NORMAL")
+            if self.archive_path is not None:
+                connection.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+                connection.execute("PRAGMA archive.journal_mode=WAL")
+                connection.execute("PRAGMA archive.synchronous=NORMAL")
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    def _run_read(self, func, args):
+        return func(self.get_connection(), *args)
+
+    #runs func inside one transaction: everything is saved together, or nothing is saved if it fails
+    def _run_write(self, func, args):
+        connection = self.get_connection()
+        try:
+            result = func(connection, *args)
+            connection.commit()
+            self.commits += 1
+            return result
+        except Exception:
+            #rollback() undoes all changes made in the database if something went wrong in the middle
+            connection.rollback()
+            raise
+
+    #run a read-only function on one of the reader threads
+    async def read(self, func, *args):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.readers, self._run_read, func, args)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - start, func.__name__.lstrip("_"))
+
+    #run a function that changes the database on the writer thread
+    async def write(self, func, *args):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.writer, self._run_write, func, args)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - start, func.__name__.lstrip("_"))
+
+    #same as write(), for code that is not async (e.g. creating the tables at startup)
+    def write_sync(self, func, *args):
+        return self.writer.submit(self._run_write, func, args).result()
+
+    #waits for the queued queries to finish, then closes every connection
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+
+
+#saves chat messages in the background instead of one commit (and one disk flush) per message
+#messages wait in a queue and a background task writes them in one transaction every MESSAGE_BATCH_SIZE messages or MESSAGE_FLUSH_MS milliseconds
+class MessageWriter:
+    def __init__(self, pool: ConnectionPool, batch_size: int = 100, flush_ms: int = 50, durability: str = "async", max_queued: int = 10000):
+        if durability not in ("async", "sync"):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.durability = durability
+        #every item is (sender_id, recipient_id, content, timestamp, future, room_id, saved), or None to tell the task to stop
+        #room messages have a room_id and no recipient_id, direct messages the other way around
+        #saved is what on_saved gets for the message once it is committed (only in "async" mode, in "sync" mode the sender gets the id back)
+        #it is bounded, so a database that can't keep up slows the senders down instead of filling the memory
+        self.queue: asyncio.Queue = asyncio.Queue(max_queued)
+        self.task = None
+        #called after every committed batch with [(saved, message_id), ...], so clients can learn the ids of live messages
+        self.on_saved = None
+        #messages and batches saved so far
+        self.written = 0
+        self.batches = 0
+
+    #number of messages waiting to be written
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    #writes everything that is still queued, then stops the background task
+    async def stop(self):
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    #queue a message. In "sync" mode this waits for the commit and returns the new message_id, in "async" mode it returns None right away
+    #pass room_id (and no recipient_id) for a room message
+    async def enqueue(self, sender_id: int, recipient_id, content: str, room_id: int = None, saved=None):
+        self.start()
+        #same format as sqlite's CURRENT_TIMESTAMP, taken now rather than when the batch is written
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        future = asyncio.get_running_loop().create_future() if self.durability == "sync" else None
+        #waits while the queue is full
+        await self.queue.put((sender_id, recipient_id, content, timestamp, future, room_id, saved if future is None else None))
+        if future is not None:
+            return await future
+        return None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            #keep collecting until the batch is full or the oldest message has waited long enough
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self.flush(batch)
+
+    async def flush(self, batch):
+        direct = [item for item in batch if item[5] is None]
+        rooms = [item for item in batch if item[5] is not None]
+        rows = [item[:4] for item in direct]
+        room_rows = [(item[5], item[0], item[2], item[3]) for item in rooms]
+        delay = 0.05
+        while True:
+            try:
+                first_ids = await self.pool.write(self._insert_batch, rows, room_rows)
+                break
+            except Exception as e:
+                #in "async" mode these messages were already delivered, so a batch is only given up when retrying can't help
+                #(another worker holding the write lock, or a full disk, goes away by itself)
+                if getattr(e, "sqlite_errorcode", 0) & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED, sqlite3.SQLITE_FULL):
+                    log.warning("failed to save messages, retrying", extra={"count": len(batch), "error": str(e), "retry_in": delay})
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5)
+                    continue
+                log.error("failed to save messages", extra={"count": len(batch), "error": str(e)})
+                for item in batch:
+                    if item[4] is not None and not item[4].done():
+                        item[4].set_exception(e)
+                return
+        self.written += len(batch)
+        self.batches += 1
+        saved = []
+        for items, first_id in zip((direct, rooms), first_ids):
+            for i, item in enumerate(items):
+                if item[4] is not None and not item[4].done():
+                    item[4].set_result(first_id + i)
+                if item[6] is not None:
+                    saved.append((item[6], first_id + i))
+        if saved and self.on_saved is not None:
+            self.on_saved(saved)
+
+    #inserts the whole batch in one transaction, so the batch costs a single commit
+    #returns the first new message_id of the direct messages and of the room messages
+    def _insert_batch(self, connection: sqlite3.Connection, rows, room_rows):
+        cursor = connection.cursor()
+        #IMMEDIATE takes the write lock now, so no one else can insert between reading MAX() and our insert
+        cursor.execute("BEGIN IMMEDIATE")
+        first_room_id = None
+        if room_rows:
+            #a room message is stored once, however many members the room has
+            cursor.execute("SELECT COALESCE(MAX(message_id), 0) FROM room_messages")
+            first_room_id = cursor.fetchone()[0] + 1
+            cursor.executemany("""
+                INSERT INTO room_messages (message_id, room_id, sender_id, content, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(first_room_id + i, *row) for i, row in enumerate(room_rows)])
+        if not rows:
+            return None, first_room_id
+        cursor.execute("SELECT COALESCE(MAX(message_id), 0) FROM messages")
+        first_id = cursor.fetchone()[0] + 1
+        #message_ids are given out here so every message in the batch knows its id without a query per row
+        cursor.executemany("""
+            INSERT INTO messages (message_id, sender_id, recipient_id, content, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(first_id + i, *row) for i, row in enumerate(rows)])
+
+        #keep the inbox (conversations table) up to date in the same transaction
+        #the batch is first summed up per conversation, so each conversation is written once
+        conversations = {}
+        for i, (sender_id, recipient_id, content, timestamp) in enumerate(rows):
+            user_low, user_high = min(sender_id, recipient_id), max(sender_id, recipient_id)
+            conversation = conversations.setdefault((user_low, user_high), [0, None, 0, 0])
+            conversation[0] = first_id + i
+            conversation[1] = timestamp
+            #the recipient has one more unread message (unless they are talking to themselves)
+            if recipient_id != sender_id:
+                conversation[2 if recipient_id == user_low else 3] += 1
+        cursor.executemany("""
+            INSERT INTO conversations (user_low, user_high, last_message_id, last_timestamp, unread_low, unread_high)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_low, user_high) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_timestamp = excluded.last_timestamp,
+                unread_low = unread_low + excluded.unread_low,
+                unread_high = unread_high + excluded.unread_high
+        """, [(*pair, *values) for pair, values in conversations.items()])
+        return first_id, first_room_id
+
+
+#remembers username -> user_id so we don't have to ask the database every time
+#a user's id never changes once the row exists, so an entry only leaves the cache when it gets evicted (or invalidate() is called)
+#"LRU" (least recently used): when the cache is full, the username that was looked up longest ago is thrown out
+class IdentityCache:
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        #OrderedDict remembers the order of the keys, the most recently used username is kept at the end
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    #returns the cached user_id, or None if the username is not in the cache
+    def get(self, username: str):
+        user_id = self.entries.get(username)
+        if user_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(username)
+        return user_id
+
+    def put(self, username: str, user_id: int):
+        self.entries[username] = user_id
+        self.entries.move_to_end(username)
+        if len(self.entries) > self.max_size:
+            #last=False removes the oldest entry
+            self.entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        self.entries.pop(username, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+#remembers each user's friends and the friend requests waiting for them, so these lists don't need a JOIN every time
+#every change to the friends table updates the cache right after it is saved ("write-through"), so it never goes stale
+#users who haven't been looked up for a while are evicted first (LRU), just like in IdentityCache
+class SocialGraphCache:
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        #username: {"friends": {...}, "pending": {...}}, both are dicts used as ordered sets of usernames
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        #goes up on every change, so a load that raced with a change can tell its result may be out of date
+        self.generation = 0
+        #called with the usernames whose entries changed (used to tell the other workers)
+        self.on_change = None
+
+    def get(self, username: str):
+        entry = self.entries.get(username)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(username)
+        return entry
+
+    def put(self, username: str, friends, pending):
+        self.entries[username] = {"friends": dict.fromkeys(friends), "pending": dict.fromkeys(pending)}
+        self.entries.move_to_end(username)
+        if len(self.entries) > self.max_users:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        self.entries.pop(username, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    #the write-through updates below only touch users that are cached, the others are loaded fresh when needed
+    def request_sent(self, sender: str, recipient: str):
+        if recipient in self.entries:
+            self.entries[recipient]["pending"][sender] = None
+        self.changed(sender, recipient)
+
+    def request_answered(self, responder: str, requester: str, accepted: bool):
+        if responder in self.entries:
+            self.entries[responder]["pending"].pop(requester, None)
+            if accepted:
+                self.entries[responder]["friends"][requester] = None
+        if accepted and requester in self.entries:
+            self.entries[requester]["friends"][responder] = None
+        self.changed(responder, requester)
+
+    #remove_friend deletes every row between the two users, accepted or not
+    def friendship_removed(self, user1: str, user2: str):
+        for username, other in ((user1, user2), (user2, user1)):
+            if username in self.entries:
+                self.entries[username]["friends"].pop(other, None)
+                self.entries[username]["pending"].pop(other, None)
+        self.changed(user1, user2)
+
+    def changed(self, *usernames):
+        self.generation += 1
+        if self.on_change is not None:
+            self.on_change(list(usernames))
+
+
+#remembers who is in each room, so sending to a room doesn't read its member list from the database every time
+#kept up to date the same way as SocialGraphCache: written through on every change, the other workers are told to drop their copy
+class RoomCache:
+    def __init__(self, max_rooms: int = 1000):
+        self.max_rooms = max_rooms
+        #room_id: {"name": ..., "members": {...}}, members is a dict used as an ordered set of usernames
+        self.entries: "OrderedDict[int, dict]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        #goes up on every change, so a load that raced with a change can tell its result may be out of date
+        self.generation = 0
+        #called with the room_id that changed (used to tell the other workers)
+        self.on_change = None
+
+    def get(self, room_id: int):
+        entry = self.entries.get(room_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(room_id)
+        return entry
+
+    def put(self, room_id: int, name: str, members):
+        self.entries[room_id] = {"name": name, "members": dict.fromkeys(members)}
+        self.entries.move_to_end(room_id)
+        if len(self.entries) > self.max_rooms:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, room_id: int):
+        self.entries.pop(room_id, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def members_added(self, room_id: int, usernames):
+        if room_id in self.entries:
+            self.entries[room_id]["members"].update(dict.fromkeys(usernames))
+        self.changed(room_id)
+
+    def member_left(self, room_id: int, username: str):
+        if room_id in self.entries:
+            self.entries[room_id]["members"].pop(username, None)
+        self.changed(room_id)
+
+    def changed(self, room_id: int):
+        self.generation += 1
+        if self.on_change is not None:
+            self.on_change(room_id)
+
+
+#an archive segment is a run of one conversation's messages, stored as zlib-compressed JSON
+#rows are (message_id, sender_id, recipient_id, content, timestamp), the same columns as the messages table
+def pack_segment(rows) -> bytes:
+    return zlib.compress(json.dumps(rows, separators=(",", ":"), ensure_ascii=False).encode(), 6)
+
+
+def unpack_segment(data: bytes):
+    return [tuple(row) for row in json.loads(zlib.decompress(data))]
+
+
+#merges two pages of rows that are both sorted by message_id in the given order, keeping the first "limit"
+#a message found in both (only possible if the archiver was stopped halfway) is listed once
+def merge_pages(first, second, order: str, limit: int):
+    rows = {row[0]: row for row in first}
+    rows.update((row[0], row) for row in second)
+    return sorted(rows.values(), key=lambda row: row[0], reverse=order == "DESC")[:limit]
+
+
+#turns what the user typed into an FTS5 query: every word must appear, and nothing they type is read as query syntax
+def search_query(text: str) -> str:
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
 #handles database actions for users and friendships
+#every public method is async and runs its SQL on the pool, so the endpoints can simply "await" them
+#the SQL itself lives in the matching "_" method, which receives the connection it should use
 class Database:
     #called when you make a new Database() object
-    def __init__(self):
-        #"check_same_thread" is needed because FastAPI is async and may run on different threads, it turns sqlite3's security off
-        #sqlite3 will raise an error if different threads try to use the same database connection
-        self.connection = sqlite3.connect("user.db", check_same_thread=False)
-        self.create_tables()
+    def __init__(self, path: str = "user.db", readers: int = 4, archive_path: str = None):
+        #old messages live in their own file next to the database, see MessageArchiver
+        self.pool = ConnectionPool(path, readers, archive_path or os.path.splitext(path)[0] + ".archive.db")
+        self.pool.write_sync(self.create_tables)
+        self.identity_cache = IdentityCache(IDENTITY_CACHE_SIZE)
+        self.social_graph = SocialGraphCache(SOCIAL_GRAPH_CACHE_SIZE)
+        self.room_cache = RoomCache(ROOM_CACHE_SIZE)
+        self.message_writer = MessageWriter(self.pool, MESSAGE_BATCH_SIZE, MESSAGE_FLUSH_MS, MESSAGE_DURABILITY, MESSAGE_QUEUE_SIZE)
+        #with synchronous=NORMAL a WAL commit is not on the disk yet (a power cut can still undo it), so in "sync" mode the writer flushes every commit
+        if MESSAGE_DURABILITY == "sync":
+            self.pool.write_sync(self._flush_every_commit)
     
+    def _flush_every_commit(self, connection: sqlite3.Connection):
+        connection.execute("PRAGMA synchronous=FULL")
+
     #create the users and friends tables if they don't already exist
-    def create_tables(self):
+    def create_tables(self, connection: sqlite3.Connection):
         #cursor allows you to send SQL commands to the database
-        cursor = self.connection.cursor()
+        cursor = connection.cursor()
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -99,98 +945,636 @@ class Database:
                 FOREIGN KEY(recipient_id) REFERENCES users(user_id)                  
             )
         """)
-        #save all the table creation to the database permanently
-        self.connection.commit()
+        #lets a conversation page jump straight to the right messages instead of scanning the whole table
+        #message_id is part of the index, so the pages come out of it already sorted
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation
+            ON messages(sender_id, recipient_id, message_id)
+        """)
+        #lets a user catch up on everything sent to them after a given message_id, across all conversations
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_messages_inbox
+            ON messages(recipient_id, message_id)
+        """)
 
-    def save_message(self, sender: str, recipient: str, content: str):
-        cursor = self.connection.cursor()
-        
-        cursor.execute("SELECT user_id FROM users WHERE username=?", (sender,))
-        sender_id = cursor.fetchone()[0]
-        cursor.execute("SELECT user_id FROM users WHERE username=?", (recipient,))
-        recipient_id = cursor.fetchone()[0]
-        
+        #one row per pair of users who have talked, so the inbox doesn't have to scan the messages
+        #the pair is stored with the smaller user_id first, so (a, b) and (b, a) are the same row
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='conversations'")
+        conversations_existed = cursor.fetchone() is not None
         cursor.execute("""
-            INSERT INTO messages (sender_id, recipient_id, content)
-            VALUES (?, ?, ?)
-        """, (sender_id, recipient_id, content))
-        self.connection.commit()
-    
-    def get_conversation(self, user1: str, user2: str):
-        cursor = self.connection.cursor()
-        
-        cursor.execute("SELECT user_id FROM users WHERE username=?", (user1,))
-        user1_id = cursor.fetchone()[0]
-        cursor.execute("SELECT user_id FROM users WHERE username=?", (user2,))
-        user2_id = cursor.fetchone()[0]
-        
+            CREATE TABLE IF NOT EXISTS conversations (
+                user_low INTEGER NOT NULL, --the smaller user_id of the two
+                user_high INTEGER NOT NULL, --the bigger user_id of the two
+                last_message_id INTEGER NOT NULL,
+                last_timestamp DATETIME,
+                unread_low INTEGER NOT NULL DEFAULT 0, --messages user_low hasn't read yet
+                unread_high INTEGER NOT NULL DEFAULT 0, --messages user_high hasn't read yet
+                read_low INTEGER NOT NULL DEFAULT 0, --the last message_id user_low has read
+                read_high INTEGER NOT NULL DEFAULT 0, --the last message_id user_high has read
+                PRIMARY KEY(user_low, user_high),
+                FOREIGN KEY(user_low) REFERENCES users(user_id),
+                FOREIGN KEY(user_high) REFERENCES users(user_id)
+            )
+        """)
+        #databases from before read receipts
+        cursor.execute("PRAGMA table_info(conversations)")
+        if "read_low" not in {column[1] for column in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE conversations ADD COLUMN read_low INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("ALTER TABLE conversations ADD COLUMN read_high INTEGER NOT NULL DEFAULT 0")
+        #the primary key already finds a user's rows when they are user_low, this finds them when they are user_high
         cursor.execute("""
-            SELECT u1.username as sender, u2.username as recipient, m.content, m.timestamp
-            FROM messages m
-            JOIN users u1 ON m.sender_id = u1.user_id
-            JOIN users u2 ON m.recipient_id = u2.user_id
-            WHERE (m.sender_id = ? AND m.recipient_id = ?)
-            OR (m.sender_id = ? AND m.recipient_id = ?)
-            ORDER BY m.timestamp
-        """, (user1_id, user2_id, user2_id, user1_id))
-        
+            CREATE INDEX IF NOT EXISTS idx_conversations_high
+            ON conversations(user_high)
+        """)
+        #databases from before the conversations table: fill it once from the existing messages (everything counts as read)
+        if not conversations_existed:
+            cursor.execute("""
+                INSERT INTO conversations (user_low, user_high, last_message_id, last_timestamp)
+                SELECT MIN(sender_id, recipient_id), MAX(sender_id, recipient_id), MAX(message_id), NULL
+                FROM messages
+                GROUP BY MIN(sender_id, recipient_id), MAX(sender_id, recipient_id)
+            """)
+            cursor.execute("""
+                UPDATE conversations
+                SET last_timestamp = (SELECT timestamp FROM messages WHERE message_id = conversations.last_message_id)
+            """)
+
+        #group chats: a room has members, and its messages are stored once for everybody (not once per member)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS rooms (
+                room_id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                created_by INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(created_by) REFERENCES users(user_id)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS room_members (
+                room_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY(room_id, user_id),
+                FOREIGN KEY(room_id) REFERENCES rooms(room_id),
+                FOREIGN KEY(user_id) REFERENCES users(user_id)
+            )
+        """)
+        #the primary key finds a room's members, this finds a user's rooms
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_room_members_user
+            ON room_members(user_id)
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS room_messages (
+                message_id INTEGER PRIMARY KEY,
+                room_id INTEGER NOT NULL,
+                sender_id INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(room_id) REFERENCES rooms(room_id),
+                FOREIGN KEY(sender_id) REFERENCES users(user_id)
+            )
+        """)
+        #room history pages, same idea as idx_messages_conversation
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_room_messages_room
+            ON room_messages(room_id, message_id)
+        """)
+
+        #old messages, moved here by MessageArchiver: one row per segment of ARCHIVE_SEGMENT_SIZE messages of one conversation
+        #a conversation's segments never overlap, and they are all older than its messages still in the messages table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS archive.segments (
+                segment_id INTEGER PRIMARY KEY,
+                user_low INTEGER NOT NULL, --same pair as in the conversations table
+                user_high INTEGER NOT NULL,
+                first_id INTEGER NOT NULL, --message_id of the first and the last message in the segment
+                last_id INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                data BLOB NOT NULL --see pack_segment
+            )
+        """)
+        #finds a conversation's segments in order (first_id is in the index so paging doesn't have to read the rows)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS archive.idx_segments_conversation
+            ON segments(user_low, user_high, last_id, first_id)
+        """)
+        #the index above finds a user's segments when they are user_low, this finds them when they are user_high
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS archive.idx_segments_high
+            ON segments(user_high, last_id)
+        """)
+        #archived messages stay searchable through a search index of their own in the archive file
+        #it is contentless (content=''): it only holds the index, the text is in the segments
+        #archived_messages says which segment a search hit is in, and who it is between (to limit a search to one user's messages)
+        cursor.execute("SELECT 1 FROM archive.sqlite_master WHERE type='table' AND name='archived_messages'")
+        archive_search_existed = cursor.fetchone() is not None
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS archive.archived_messages (
+                message_id INTEGER PRIMARY KEY,
+                sender_id INTEGER NOT NULL,
+                recipient_id INTEGER NOT NULL,
+                segment_id INTEGER NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS archive.archived_fts USING fts5(
+                content,
+                content='',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        #archives from before their search index: index the segments that are already there
+        if not archive_search_existed:
+            cursor.execute("SELECT segment_id, data FROM archive.segments")
+            for segment_id, data in cursor.fetchall():
+                self._index_segment(cursor, segment_id, unpack_segment(data))
+
+        #full-text index over the message contents, used by search_messages
+        #it stores only the index, the text itself is read from the messages table (content='messages')
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'")
+        search_existed = cursor.fetchone() is not None
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content,
+                content='messages',
+                content_rowid='message_id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        #the triggers keep the index in step with the messages table, whoever writes to it
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, content) VALUES (new.message_id, new.content);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.message_id, old.content);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.message_id, old.content);
+                INSERT INTO messages_fts(rowid, content) VALUES (new.message_id, new.content);
+            END
+        """)
+        #databases from before the index: remember which messages still need indexing, backfill_search.py does it in small chunks
+        #(doing it here would lock the whole database while a big history is indexed)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS search_backfill (
+                next_id INTEGER NOT NULL, --messages after this one still need indexing...
+                end_id INTEGER NOT NULL --...up to and including this one
+            )
+        """)
+        if not search_existed:
+            cursor.execute("""
+                INSERT INTO search_backfill (next_id, end_id)
+                SELECT 0, MAX(message_id) FROM messages HAVING MAX(message_id) IS NOT NULL
+            """)
+
+    #returns the user_id of a username, or None if the user does not exist
+    #answered from the identity cache when possible, only unknown usernames go to the database
+    async def get_user_id(self, username: str):
+        user_id = self.identity_cache.get(username)
+        if user_id is not None:
+            return user_id
+        user_id = await self.pool.read(self._get_user_id, username)
+        #users that don't exist are not cached, they may sign up later
+        if user_id is not None:
+            self.identity_cache.put(username, user_id)
+        return user_id
+
+    def _get_user_id(self, connection: sqlite3.Connection, username: str):
+        cursor = connection.cursor()
+        cursor.execute("SELECT user_id FROM users WHERE username=?", (username,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    #hands the message to the message writer, which saves it in the background (see MessageWriter)
+    #returns the new message_id in "sync" mode, in "async" mode the two users get it later in a "messages_saved" event
+    #client_id is whatever the sender's client tagged the message with, it comes back with the message_id
+    async def save_message(self, sender: str, recipient: str, content: str, client_id=None):
+        sender_id = await self.get_user_id(sender)
+        recipient_id = await self.get_user_id(recipient)
+        if sender_id is None or recipient_id is None:
+            return None
+        saved = {"from": sender, "to": recipient, "client_id": client_id, "notify": [sender, recipient]}
+        return await self.message_writer.enqueue(sender_id, recipient_id, content, saved=saved)
+    
+    #returns one page of the conversation between two users, oldest message first
+    #pages are found by message_id ("keyset pagination"), so a page costs the same however long the conversation is:
+    #  no ids: the newest "limit" messages
+    #  before_id: the "limit" messages just before that message (scrolling up)
+    #  after_id: the "limit" messages just after that message (catching up)
+    async def get_conversation(self, user1: str, user2: str, limit: int = HISTORY_PAGE_SIZE, before_id: int = None, after_id: int = None):
+        user1_id = await self.get_user_id(user1)
+        user2_id = await self.get_user_id(user2)
+        if user1_id is None or user2_id is None:
+            return []
+        rows = await self.pool.read(self._get_conversation, user1_id, user2_id, limit, before_id, after_id)
+        #both usernames are already known, so there is no need to JOIN the users table
+        usernames = {user1_id: user1, user2_id: user2}
+        return [{
+            'message_id': row[0],
+            'sender': usernames[row[1]],
+            'recipient': usernames[row[2]],
+            'content': row[3],
+            'timestamp': row[4]
+        } for row in rows]
+
+    def _get_conversation(self, connection: sqlite3.Connection, user1_id: int, user2_id: int, limit: int, before_id, after_id):
+        cursor = connection.cursor()
+        lower = after_id if after_id is not None else 0
+        upper = before_id if before_id is not None else 2 ** 63 - 1
+        #after_id reads forwards from the cursor, otherwise we read backwards from the newest message
+        order = "ASC" if after_id is not None else "DESC"
+        #each direction of the conversation is read from the index separately, then the two are merged
+        #UNION (not UNION ALL) so that a conversation with yourself doesn't list every message twice
+        cursor.execute(f"""
+            SELECT * FROM (
+                SELECT message_id, sender_id, recipient_id, content, timestamp FROM messages
+                WHERE sender_id = ? AND recipient_id = ? AND message_id > ? AND message_id < ?
+                ORDER BY message_id {order} LIMIT ?
+            )
+            UNION
+            SELECT * FROM (
+                SELECT message_id, sender_id, recipient_id, content, timestamp FROM messages
+                WHERE sender_id = ? AND recipient_id = ? AND message_id > ? AND message_id < ?
+                ORDER BY message_id {order} LIMIT ?
+            )
+            ORDER BY message_id {order} LIMIT ?
+        """, (user1_id, user2_id, lower, upper, limit, user2_id, user1_id, lower, upper, limit, limit))
+        rows = cursor.fetchall()
+        #archived messages are older than everything the conversation still has in the messages table,
+        #so the archive is only read when the messages table alone doesn't fill the page
+        if len(rows) < limit or order == "ASC":
+            low, high = min(user1_id, user2_id), max(user1_id, user2_id)
+            archived = self._read_archive(cursor, low, high, lower, upper, order, limit)
+            rows = merge_pages(archived, rows, order, limit)
+        if order == "DESC":
+            rows.reverse()
+        return rows
+
+    #one conversation's archived messages with lower < message_id < upper, in the given order, at least "limit" of them if there are that many
+    def _read_archive(self, cursor: sqlite3.Cursor, low: int, high: int, lower: int, upper: int, order: str, limit: int):
+        cursor.execute(f"""
+            SELECT data FROM archive.segments
+            WHERE user_low = ? AND user_high = ? AND last_id > ? AND first_id < ?
+            ORDER BY last_id {order}
+        """, (low, high, lower, upper))
+        rows = []
+        #segments are only decompressed until the page is full
+        for (data,) in cursor:
+            segment = [row for row in unpack_segment(data) if lower < row[0] < upper]
+            rows.extend(segment if order == "ASC" else reversed(segment))
+            if len(rows) >= limit:
+                break
+        return rows
+
+    #returns the messages sent to a user after since_id (in every conversation), oldest first, at most "limit" of them
+    #a client remembers the last message_id it has seen and passes it here when it reconnects,
+    #so catching up costs as much as what was missed, not the whole history
+    async def get_messages_since(self, username: str, since_id: int = 0, limit: int = SYNC_PAGE_SIZE):
+        user_id = await self.get_user_id(username)
+        if user_id is None:
+            return []
+        rows = await self.pool.read(self._get_messages_since, user_id, since_id, limit)
         return [{
-            'sender': row[0],
-            'recipient': row[1],
+            'message_id': row[0],
+            'sender': row[1],
+            'recipient': username,
             'content': row[2],
             'timestamp': row[3]
-        } for row in cursor.fetchall()]
+        } for row in rows]
+
+    def _get_messages_since(self, connection: sqlite3.Connection, user_id: int, since_id: int, limit: int):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT m.message_id, u.username, m.content, m.timestamp
+            FROM messages m
+            JOIN users u ON m.sender_id = u.user_id --find sender's username
+            WHERE m.recipient_id = ? AND m.message_id > ?
+            ORDER BY m.message_id
+            LIMIT ?
+        """, (user_id, since_id, limit))
+        rows = cursor.fetchall()
+        #a client that has been away longer than ARCHIVE_AFTER_DAYS also needs what was archived in the meantime
+        archived = self._read_archive_since(cursor, user_id, since_id, limit)
+        if not archived:
+            return rows
+        cursor.execute(f"""
+            SELECT user_id, username FROM users WHERE user_id IN ({",".join("?" * len({row[1] for row in archived}))})
+        """, tuple({row[1] for row in archived}))
+        usernames = dict(cursor.fetchall())
+        archived = [(row[0], usernames[row[1]], row[3], row[4]) for row in archived]
+        return merge_pages(archived, rows, "ASC", limit)
+
+    #the first "limit" archived messages sent to a user after since_id, across all their conversations
+    def _read_archive_since(self, cursor: sqlite3.Cursor, user_id: int, since_id: int, limit: int):
+        cursor.execute("""
+            SELECT first_id, data FROM (
+                SELECT first_id, data FROM archive.segments WHERE user_low = ? AND last_id > ?
+                UNION ALL
+                SELECT first_id, data FROM archive.segments WHERE user_high = ? AND last_id > ? AND user_low != user_high
+            )
+            ORDER BY first_id
+        """, (user_id, since_id, user_id, since_id))
+        rows = []
+        for first_id, data in cursor.fetchall():
+            #segments come in order of their first message, so once the page is full a later segment can't have anything earlier
+            if len(rows) >= limit and first_id > rows[limit - 1][0]:
+                break
+            rows.extend(row for row in unpack_segment(data) if row[2] == user_id and row[0] > since_id)
+            rows.sort()
+        return rows[:limit]
+
+    #searches the messages a user sent or received, best matches first
+    #with_user limits the search to the conversation with that user, offset skips the results of earlier pages
+    async def search_messages(self, username: str, text: str, with_user: str = None, limit: int = SEARCH_PAGE_SIZE, offset: int = 0):
+        user_id = await self.get_user_id(username)
+        query = search_query(text)
+        if user_id is None or not query:
+            return []
+        other_id = None
+        if with_user is not None:
+            other_id = await self.get_user_id(with_user)
+            if other_id is None:
+                return []
+        rows = await self.pool.read(self._search_messages, user_id, query, other_id, limit, offset)
+        return [{
+            'message_id': row[0],
+            'sender': row[1],
+            'recipient': row[2],
+            'content': row[3],
+            'timestamp': row[4]
+        } for row in rows]
+
+    def _search_messages(self, connection: sqlite3.Connection, user_id: int, query: str, other_id, limit: int, offset: int):
+        cursor = connection.cursor()
+        if other_id is None:
+            where, args = "(m.sender_id = ? OR m.recipient_id = ?)", (user_id, user_id)
+        else:
+            where, args = "((m.sender_id = ? AND m.recipient_id = ?) OR (m.sender_id = ? AND m.recipient_id = ?))", (user_id, other_id, other_id, user_id)
+        #both the messages table and the archive have their own index, the best limit + offset of each are merged
+        #rank is FTS5's bm25 score, lower is a better match
+        cursor.execute(f"""
+            SELECT messages_fts.rank, m.message_id, s.username, r.username, m.content, m.timestamp
+            FROM messages_fts
+            JOIN messages m ON m.message_id = messages_fts.rowid
+            JOIN users s ON m.sender_id = s.user_id
+            JOIN users r ON m.recipient_id = r.user_id
+            WHERE messages_fts MATCH ? AND {where}
+            ORDER BY messages_fts.rank, m.message_id DESC
+            LIMIT ?
+        """, (query, *args, limit + offset))
+        results = {row[1]: row for row in cursor.fetchall()}
+        cursor.execute(f"""
+            SELECT archived_fts.rank, m.message_id, s.username, r.username, m.segment_id
+            FROM archived_fts
+            JOIN archive.archived_messages m ON m.message_id = archived_fts.rowid
+            JOIN users s ON m.sender_id = s.user_id
+            JOIN users r ON m.recipient_id = r.user_id
+            WHERE archived_fts MATCH ? AND {where}
+            ORDER BY archived_fts.rank, m.message_id DESC
+            LIMIT ?
+        """, (query, *args, limit + offset))
+        hits = cursor.fetchall()
+        #the text and the timestamp of an archived hit are in its segment, each segment is unpacked once
+        segments = {}
+        for segment_id in {hit[4] for hit in hits}:
+            cursor.execute("SELECT data FROM archive.segments WHERE segment_id = ?", (segment_id,))
+            segments.update((row[0], row) for row in unpack_segment(cursor.fetchone()[0]))
+        for rank, message_id, sender, recipient, _ in hits:
+            #a message the archiver hasn't deleted from the messages table yet is found in both
+            if message_id not in results:
+                row = segments[message_id]
+                results[message_id] = (rank, message_id, sender, recipient, row[3], row[4])
+        rows = sorted(results.values(), key=lambda row: (row[0], -row[1]))
+        return [row[1:] for row in rows[offset:offset + limit]]
+
+    #indexes the next chunk of messages that are older than the search index, see backfill_search.py
+    #returns (messages indexed, messages still waiting), each chunk is its own short transaction
+    async def backfill_search(self, chunk_size: int = 5000):
+        return await self.pool.write(self._backfill_search, chunk_size)
+
+    def _backfill_search(self, connection: sqlite3.Connection, chunk_size: int):
+        cursor = connection.cursor()
+        cursor.execute("SELECT next_id, end_id FROM search_backfill")
+        row = cursor.fetchone()
+        if row is None:
+            return 0, 0
+        next_id, end_id = row
+        cursor.execute("""
+            SELECT message_id, content FROM messages
+            WHERE message_id > ? AND message_id <= ?
+            ORDER BY message_id LIMIT ?
+        """, (next_id, end_id, chunk_size))
+        rows = cursor.fetchall()
+        cursor.executemany("INSERT INTO messages_fts(rowid, content) VALUES (?, ?)", rows)
+        if len(rows) < chunk_size:
+            cursor.execute("DELETE FROM search_backfill")
+            return len(rows), 0
+        cursor.execute("UPDATE search_backfill SET next_id = ?", (rows[-1][0],))
+        cursor.execute("SELECT COUNT(*) FROM messages WHERE message_id > ? AND message_id <= ?", (rows[-1][0], end_id))
+        return len(rows), cursor.fetchone()[0]
+
+    #returns everyone the user has talked to, newest conversation first, with the last message and how many are unread
+    async def get_inbox(self, username: str):
+        user_id = await self.get_user_id(username)
+        if user_id is None:
+            return []
+        rows = await self.pool.read(self._get_inbox, user_id)
+        return [{
+            'user': row[0],
+            'last_message': {
+                'message_id': row[1],
+                'sender': row[2],
+                'content': row[3],
+                'timestamp': row[4]
+            },
+            'unread': row[5],
+            #read receipts: the last message this user has read, and the last one the other user has read
+            'last_read_id': row[6],
+            'other_last_read_id': row[7]
+        } for row in rows]
+
+    def _get_inbox(self, connection: sqlite3.Connection, user_id: int):
+        cursor = connection.cursor()
+        #the user is either user_low or user_high of a conversation, each half uses its own index
+        cursor.execute("""
+            SELECT other.username, m.message_id, sender.username, m.content, m.timestamp, c.unread, c.read, c.other_read
+            FROM (
+                SELECT user_high AS other_id, last_message_id, unread_low AS unread, read_low AS read, read_high AS other_read
+                FROM conversations WHERE user_low = ?
+                UNION ALL
+                SELECT user_low AS other_id, last_message_id, unread_high AS unread, read_high AS read, read_low AS other_read
+                FROM conversations WHERE user_high = ? AND user_low != user_high
+            ) c
+            JOIN users other ON other.user_id = c.other_id
+            JOIN messages m ON m.message_id = c.last_message_id
+            JOIN users sender ON sender.user_id = m.sender_id
+            ORDER BY c.last_message_id DESC
+        """, (user_id, user_id))
+        return cursor.fetchall()
+
+    #the user has read their conversation with other_user, so its unread counter goes back to 0
+    async def mark_read(self, username: str, other_user: str) -> bool:
+        user_id = await self.get_user_id(username)
+        other_id = await self.get_user_id(other_user)
+        if user_id is None or other_id is None:
+            return False
+        return await self.pool.write(self._mark_read, user_id, other_id)
+
+    def _mark_read(self, connection: sqlite3.Connection, user_id: int, other_id: int) -> bool:
+        cursor = connection.cursor()
+        #which counter is ours depends on which of the two ids is smaller
+        column = "unread_low" if user_id < other_id else "unread_high"
+        cursor.execute(f"""
+            UPDATE conversations SET {column} = 0
+            WHERE user_low = ? AND user_high = ?
+        """, (min(user_id, other_id), max(user_id, other_id)))
+        return cursor.rowcount > 0
+
+    #the newest message_id of the conversation between each pair of users, in one read
+    #returns {(user1, user2): message_id}, pairs without a conversation (or with a user that doesn't exist) are left out
+    #a read receipt can only be for a message up to this one
+    async def get_last_message_ids(self, pairs):
+        rows = []
+        for user1, user2 in pairs:
+            user1_id = await self.get_user_id(user1)
+            user2_id = await self.get_user_id(user2)
+            if user1_id is not None and user2_id is not None:
+                rows.append(((user1, user2), min(user1_id, user2_id), max(user1_id, user2_id)))
+        if not rows:
+            return {}
+        return await self.pool.read(self._get_last_message_ids, rows)
+
+    def _get_last_message_ids(self, connection: sqlite3.Connection, rows):
+        cursor = connection.cursor()
+        last_ids = {}
+        for pair, low, high in rows:
+            cursor.execute("SELECT last_message_id FROM conversations WHERE user_low = ? AND user_high = ?", (low, high))
+            row = cursor.fetchone()
+            if row is not None:
+                last_ids[pair] = row[0]
+        return last_ids
+
+    #saves read receipts collected by EphemeralEvents, all in one transaction
+    #cursors is {(reader, other_user): last message_id the reader has read}
+    async def save_read_cursors(self, cursors: dict):
+        rows = []
+        for (reader, other_user), message_id in cursors.items():
+            reader_id = await self.get_user_id(reader)
+            other_id = await self.get_user_id(other_user)
+            if reader_id is not None and other_id is not None:
+                rows.append((reader_id, other_id, message_id))
+        if rows:
+            await self.pool.write(self._save_read_cursors, rows)
+
+    def _save_read_cursors(self, connection: sqlite3.Connection, rows):
+        cursor = connection.cursor()
+        #a cursor only moves forwards, and reading up to the last message also clears the unread counter (like mark_read)
+        for side in ("low", "high"):
+            cursor.executemany(f"""
+                UPDATE conversations
+                SET read_{side} = MAX(read_{side}, ?1),
+                    unread_{side} = CASE WHEN ?1 >= last_message_id THEN 0 ELSE unread_{side} END
+                WHERE user_low = ?2 AND user_high = ?3
+            """, [
+                (message_id, min(reader_id, other_id), max(reader_id, other_id))
+                for reader_id, other_id, message_id in rows
+                if (reader_id <= other_id) == (side == "low")
+            ])
+
+    #returns the stored password hash of a user, or None if the user does not exist
+    #the user_id comes back with it, so logging in also fills the identity cache
+    async def get_password(self, username: str):
+        result = await self.pool.read(self._get_password, username)
+        if result is None:
+            return None
+        self.identity_cache.put(username, result[0])
+        return result[1]
+
+    def _get_password(self, connection: sqlite3.Connection, username: str):
+        cursor = connection.cursor()
+        cursor.execute("SELECT user_id, password FROM users WHERE username=?", (username,))
+        return cursor.fetchone()
     
-    #add a user if they are new, or update their online status if they already exist
-    def add_or_update_user(self, username: str, password: str, online: bool = True):
-        cursor = self.connection.cursor()
-        cursor.execute("INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)", (username, password))
-        cursor.execute("UPDATE users SET online = ?, password = ? WHERE username = ?", (online, password, username))
-        self.connection.commit()
-
-    #mark the user offline
-    def set_user_offline(self, username: str, password: str):
-        self.add_or_update_user(username, password, online=False)
-
-    def remove_friend(self, current_user: str, target_user: str) -> bool:
-        cursor = self.connection.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE username=?", (target_user,))
-        result = cursor.fetchone()
-        if not result:
+    #adds a new user with an already hashed password. Returns False if the username is taken
+    async def add_user(self, username: str, password_hash: str) -> bool:
+        user_id = await self.pool.write(self._add_user, username, password_hash)
+        if user_id is None:
             return False
-        target_id = result[0]
+        self.identity_cache.put(username, user_id)
+        return True
 
-        cursor.execute("SELECT user_id FROM users WHERE username=?", (current_user,))
-        result = cursor.fetchone()
-        if not result:
+    def _add_user(self, connection: sqlite3.Connection, username: str, password_hash: str):
+        cursor = connection.cursor()
+        cursor.execute("INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)", (username, password_hash))
+        return cursor.lastrowid if cursor.rowcount > 0 else None
+
+    #replaces a user's password hash (when an old one is upgraded at login)
+    async def set_password(self, username: str, password_hash: str):
+        await self.pool.write(self._set_password, username, password_hash)
+
+    def _set_password(self, connection: sqlite3.Connection, username: str, password_hash: str):
+        cursor = connection.cursor()
+        cursor.execute("UPDATE users SET password = ? WHERE username = ?", (password_hash, username))
+
+    #usernames whose online column is set
+    async def get_online_users(self):
+        return await self.pool.read(self._get_online_users)
+
+    def _get_online_users(self, connection: sqlite3.Connection):
+        cursor = connection.cursor()
+        cursor.execute("SELECT username FROM users WHERE online")
+        return [row[0] for row in cursor.fetchall()]
+
+    #saves a batch of presence changes (username: online) in one transaction, see PresenceSnapshot
+    async def save_presence(self, changes: Dict[str, bool]):
+        await self.pool.write(self._save_presence, list(changes.items()))
+
+    def _save_presence(self, connection: sqlite3.Connection, changes):
+        cursor = connection.cursor()
+        cursor.executemany("UPDATE users SET online = ? WHERE username = ?", [(online, username) for username, online in changes])
+
+    async def remove_friend(self, current_user: str, target_user: str) -> bool:
+        target_id = await self.get_user_id(target_user)
+        if target_id is None:
             return False
-        current_id = result[0]
-        
-        cursor.execute("DELETE FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)", (current_id, target_id, target_id, current_id ))
+        current_id = await self.get_user_id(current_user)
+        if current_id is None:
+            return False
+        removed = await self.pool.write(self._remove_friend, current_id, target_id)
+        if removed:
+            self.social_graph.friendship_removed(current_user, target_user)
+        return removed
 
-        self.connection.commit()
+    def _remove_friend(self, connection: sqlite3.Connection, current_id: int, target_id: int) -> bool:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)", (current_id, target_id, target_id, current_id ))
         return True
 
     #sends a friend request from one user to another
-    def send_friend_request(self, sender_username: str, recipient_username: str):
-        cursor = self.connection.cursor()
-
+    async def send_friend_request(self, sender_username: str, recipient_username: str):
         #sender's username user_id
-        cursor.execute("SELECT user_id FROM users WHERE username=?", (sender_username,))
-        #get the first row found
-        sender = cursor.fetchone()
+        sender_id = await self.get_user_id(sender_username)
         #if no sender exists, abort
-        if not sender:
+        if sender_id is None:
             return False
-        #extract the actual user_id (it is in a tuple)
-        sender_id = sender[0]
 
         #recipient's username user_id
-        cursor.execute("SELECT user_id FROM users WHERE username=?", (recipient_username,))
-        recipient = cursor.fetchone()
-        if not recipient:
+        recipient_id = await self.get_user_id(recipient_username)
+        if recipient_id is None:
             return False
-        recipient_id = recipient[0]
+        sent = await self.pool.write(self._send_friend_request, sender_id, recipient_id)
+        if sent:
+            self.social_graph.request_sent(sender_username, recipient_username)
+        return sent
+
+    def _send_friend_request(self, connection: sqlite3.Connection, sender_id: int, recipient_id: int):
+        cursor = connection.cursor()
 
         #check if a friendship already exists
         cursor.execute("""SELECT 1 FROM friends --check if anything exists 
@@ -206,16 +1590,35 @@ class Database:
                           (user_id, friend_id, status, action_user_id) 
                           VALUES (?,?,?,?)""",
                        (sender_id, recipient_id, 'pending', sender_id))
-        self.connection.commit()
         return True #request was successfully sent
     
-    #returns all friend requests sent to a specific user
-    def get_pending_requests(self, username: str):
-        cursor = self.connection.cursor()
+    #returns a user's friends and pending requests from the social graph cache, loading them from the database on a miss
+    #returns None if the user does not exist
+    async def get_social_graph(self, username: str):
+        entry = self.social_graph.get(username)
+        if entry is not None:
+            return entry
         #find user_id
-        cursor.execute("SELECT user_id FROM users WHERE username=?", (username,))
-        user_id = cursor.fetchone()[0]
-        
+        user_id = await self.get_user_id(username)
+        if user_id is None:
+            return None
+        generation = self.social_graph.generation
+        friends = await self.pool.read(self._get_friends_list, user_id)
+        pending = await self.pool.read(self._get_pending_requests, user_id)
+        #only cache what we read if nothing changed in the meantime, otherwise it may already be out of date
+        if generation == self.social_graph.generation:
+            self.social_graph.put(username, friends, pending)
+        return {"friends": dict.fromkeys(friends), "pending": dict.fromkeys(pending)}
+
+    #returns all friend requests sent to a specific user
+    async def get_pending_requests(self, username: str):
+        entry = await self.get_social_graph(username)
+        if entry is None:
+            return []
+        return list(entry["pending"])
+
+    def _get_pending_requests(self, connection: sqlite3.Connection, user_id: int):
+        cursor = connection.cursor()
         #find all usernames who sent a request
         cursor.execute("""
             SELECT users.username 
@@ -227,12 +1630,14 @@ class Database:
         return [row[0] for row in cursor.fetchall()]
 
     #returns all users who are friends
-    def get_friends_list(self, username: str):
-        cursor = self.connection.cursor()
-        #find user_id
-        cursor.execute("SELECT user_id FROM users WHERE username=?", (username,))
-        user_id = cursor.fetchone()[0]
-        
+    async def get_friends_list(self, username: str):
+        entry = await self.get_social_graph(username)
+        if entry is None:
+            return []
+        return list(entry["friends"])
+
+    def _get_friends_list(self, connection: sqlite3.Connection, user_id: int):
+        cursor = connection.cursor()
         #find all usernames where friendship is accepted
         cursor.execute("""
             SELECT users.username 
@@ -244,77 +1649,767 @@ class Database:
         return [row[0] for row in cursor.fetchall()]
 
     #accept or decline a friend request
-    def respond_to_friend_request(self, responder_username, requester_username, response):
-        cursor = self.connection.cursor()
-        
+    async def respond_to_friend_request(self, responder_username, requester_username, response):
+        #get user_id's of both the responder and the requester
+        responder_id = await self.get_user_id(responder_username)
+        requester_id = await self.get_user_id(requester_username)
+        if responder_id is None or requester_id is None:
+            return False
         try:
-            #get user_id's of both the responder and the requester
-            cursor.execute("SELECT user_id FROM users WHERE username=?", (responder_username,))
-            responder_id = cursor.fetchone()[0]
-            cursor.execute("SELECT user_id FROM users WHERE username=?", (requester_username,))
-            requester_id = cursor.fetchone()[0]
+            answered = await self.pool.write(self._respond_to_friend_request, responder_id, requester_id, response)
+        except sqlite3.Error as e:
+            #the pool has already rolled back everything this call changed
+            log.error("failed to save friend response", extra={"responder": responder_username, "requester": requester_username, "error": str(e)})
+            return False
+        if answered:
+            self.social_graph.request_answered(responder_username, requester_username, response.lower() == 'accept')
+        return answered
+
+    def _respond_to_friend_request(self, connection: sqlite3.Connection, responder_id: int, requester_id: int, response):
+        cursor = connection.cursor()
 
-            #check if there is already a pending friend request
+        #check if there is already a pending friend request
+        cursor.execute("""
+            SELECT relationship_id FROM friends 
+            WHERE user_id=? AND friend_id=? AND status='pending'
+        """, (requester_id, responder_id))
+        
+        if not cursor.fetchone():
+            return False  #if no pending request, abort
+        
+        #if accepted
+        if response.lower() == 'accept':
             cursor.execute("""
-                SELECT relationship_id FROM friends 
+                UPDATE friends 
+                SET status='accepted', action_user_id=?
                 WHERE user_id=? AND friend_id=? AND status='pending'
-            """, (requester_id, responder_id))
-            
-            if not cursor.fetchone():
-                return False  #if no pending request, abort
-            
-            #if accepted
-            if response.lower() == 'accept':
-                cursor.execute("""
-                    UPDATE friends 
-                    SET status='accepted', action_user_id=?
-                    WHERE user_id=? AND friend_id=? AND status='pending'
-                """, (responder_id, requester_id, responder_id))
+            """, (responder_id, requester_id, responder_id))
 
-                cursor.execute("""
-                    INSERT OR IGNORE INTO friends
-                    (user_id, friend_id, status, action_user_id)
-                    VALUES (?, ?, 'accepted', ?)
-                """, (responder_id, requester_id, responder_id))
+            cursor.execute("""
+                INSERT OR IGNORE INTO friends
+                (user_id, friend_id, status, action_user_id)
+                VALUES (?, ?, 'accepted', ?)
+            """, (responder_id, requester_id, responder_id))
 
-            #if declined
-            else:  
-                cursor.execute("""
-                    UPDATE friends 
-                    SET status='declined', action_user_id=?
-                    WHERE user_id=? AND friend_id=? AND status='pending'
-                """, (responder_id, requester_id, responder_id))
+        #if declined
+        else:  
+            cursor.execute("""
+                UPDATE friends 
+                SET status='declined', action_user_id=?
+                WHERE user_id=? AND friend_id=? AND status='pending'
+            """, (responder_id, requester_id, responder_id))
+
+            cursor.execute("""
+                INSERT OR IGNORE INTO friends
+                (user_id, friend_id, status, action_user_id)
+                VALUES (?, ?, 'declined', ?)
+            """, (responder_id, requester_id, responder_id))
+
+        return True
+    
+    #closes the database connections when the server is closed
+    #streams the whole database as chunks of NDJSON (see Export/Import), for the /admin/export endpoint
+    #it reads through its own connection on a thread of its own, one chunk at a time, so it never holds up the pool's readers
+    async def export(self, compress: bool = False):
+        loop = asyncio.get_running_loop()
+        #a single thread, so closing (e.g. when the client goes away) always waits for the chunk being read
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-export")
+        connection = await loop.run_in_executor(executor, open_export_connection, self.pool.path, self.pool.archive_path)
+        chunks = export_chunks(export_records(connection), compress)
 
+        def close():
+            chunks.close()
+            connection.close()
+
+        try:
+            while True:
+                chunk = await loop.run_in_executor(executor, next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            executor.submit(close)
+            executor.shutdown(wait=False)
+
+    #---archive---
+    #moves up to max_messages old messages into archive segments, returns how many were moved (0 when there is nothing left to do)
+    #this is two transactions: the segments are saved first and only then deleted from the messages table,
+    #so stopping in between leaves a message in both places (the readers list it once) but never in neither
+    async def archive_messages(self, before: datetime, segment_size: int = 500, max_messages: int = 5000) -> int:
+        cutoff = before.strftime("%Y-%m-%d %H:%M:%S")
+        archived, conversations = await self.pool.write(self._archive_messages, cutoff, segment_size, max_messages)
+        if conversations:
+            await self.pool.write(self._drop_archived, conversations)
+        return archived
+
+    def _archive_messages(self, connection: sqlite3.Connection, cutoff: str, segment_size: int, max_messages: int):
+        cursor = connection.cursor()
+        #take the write lock now, so two workers archiving at once can't both archive the same messages
+        cursor.execute("BEGIN IMMEDIATE")
+        #message_ids only go up with time, so everything below the first recent message is old
+        #the newest message always stays, new message_ids are counted up from it (see MessageWriter)
+        cursor.execute("SELECT message_id FROM messages WHERE timestamp >= ? ORDER BY message_id LIMIT 1", (cutoff,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute("SELECT MAX(message_id) FROM messages")
+            row = cursor.fetchone()
+            if row[0] is None:
+                return 0, []
+            #a conversation whose last message is below this one has gone idle
+            recent_id = row[0] + 1
+        else:
+            recent_id = row[0]
+        cutoff_id = row[0]
+        #messages that backfill_search.py hasn't indexed yet stay until it has: deleting them would make the search index
+        #(which only ever saw the messages it indexed) try to remove words it doesn't have, and the delete fails
+        cursor.execute("SELECT next_id FROM search_backfill")
+        row = cursor.fetchone()
+        if row is not None:
+            cutoff_id = min(cutoff_id, row[0] + 1)
+        #only whole segments are archived, the rest of a conversation waits in the messages table until there is enough of it
+        #unless the conversation went idle (its last message is old too): then what is left goes into one last, smaller segment
+        cursor.execute("""
+            SELECT old.user_low, old.user_high, COALESCE(conversations.last_message_id < ?, 0)
+            FROM (
+                SELECT MIN(sender_id, recipient_id) AS user_low, MAX(sender_id, recipient_id) AS user_high, COUNT(*) AS count
+                FROM messages
+                WHERE message_id < ?
+                GROUP BY MIN(sender_id, recipient_id), MAX(sender_id, recipient_id)
+            ) AS old
+            LEFT JOIN conversations ON conversations.user_low = old.user_low AND conversations.user_high = old.user_high
+            --an idle conversation keeps its last message, so it needs one more to have anything to archive
+            WHERE old.count >= ? OR (conversations.last_message_id < ? AND old.count > 1)
+        """, (recent_id, cutoff_id, segment_size, recent_id))
+        archived = 0
+        conversations = []
+        for low, high, idle in cursor.fetchall():
+            if archived >= max_messages:
+                break
+            cursor.execute("SELECT COALESCE(MAX(last_id), 0) FROM archive.segments WHERE user_low = ? AND user_high = ?", (low, high))
+            archived_until = cursor.fetchone()[0]
+            #the inbox shows each conversation's last message from the messages table, so that one always stays
+            cursor.execute("SELECT last_message_id FROM conversations WHERE user_low = ? AND user_high = ?", (low, high))
+            row = cursor.fetchone()
+            upper = min(cutoff_id, row[0]) if row is not None else cutoff_id
+            budget = max(segment_size, (max_messages - archived) // segment_size * segment_size)
+            fetched = self._get_conversation(connection, low, high, budget, None, archived_until)
+            rows = [row for row in fetched if row[0] < upper]
+            #a short last segment only once every old message of the idle conversation was fetched
+            if not (idle and len(fetched) < budget):
+                rows = rows[:len(rows) // segment_size * segment_size]
+            for i in range(0, len(rows), segment_size):
+                segment = rows[i:i + segment_size]
                 cursor.execute("""
-                    INSERT OR IGNORE INTO friends
-                    (user_id, friend_id, status, action_user_id)
-                    VALUES (?, ?, 'declined', ?)
-                """, (responder_id, requester_id, responder_id))
+                    INSERT INTO archive.segments (user_low, user_high, first_id, last_id, count, data)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (low, high, segment[0][0], segment[-1][0], len(segment), pack_segment(segment)))
+                self._index_segment(cursor, cursor.lastrowid, segment)
+            archived += len(rows)
+            #also cleans up after an archiver that was stopped between its two transactions
+            if rows or archived_until:
+                conversations.append((low, high, rows[-1][0] if rows else archived_until))
+        return archived, conversations
 
-            self.connection.commit()
-            return True
+    #adds a segment's messages to the archive's search index (the messages table's index loses them when they are deleted there)
+    def _index_segment(self, cursor: sqlite3.Cursor, segment_id: int, rows):
+        cursor.executemany(
+            "INSERT INTO archive.archived_messages (message_id, sender_id, recipient_id, segment_id) VALUES (?, ?, ?, ?)",
+            [(row[0], row[1], row[2], segment_id) for row in rows]
+        )
+        cursor.executemany("INSERT INTO archive.archived_fts (rowid, content) VALUES (?, ?)", [(row[0], row[3]) for row in rows])
 
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            #rollback() undoes all changes made in the database if something went wrong in the middle
-            self.connection.rollback()
+    #deletes every message of the conversations that is already in the archive
+    def _drop_archived(self, connection: sqlite3.Connection, conversations):
+        cursor = connection.cursor()
+        for low, high, last_id in conversations:
+            cursor.execute("DELETE FROM messages WHERE sender_id = ? AND recipient_id = ? AND message_id <= ?", (low, high, last_id))
+            cursor.execute("DELETE FROM messages WHERE sender_id = ? AND recipient_id = ? AND message_id <= ?", (high, low, last_id))
+
+    #---rooms---
+    #creates a room with the creator and the given users as members, returns its room_id and the members
+    #usernames that don't exist are left out, returns (None, []) if the creator doesn't exist
+    async def create_room(self, creator: str, name: str, members):
+        creator_id = await self.get_user_id(creator)
+        if creator_id is None:
+            return None, []
+        user_ids = {creator: creator_id}
+        for username in members:
+            user_id = await self.get_user_id(username)
+            if user_id is not None and len(user_ids) < ROOM_MAX_MEMBERS:
+                user_ids[username] = user_id
+        room_id = await self.pool.write(self._create_room, creator_id, name, list(user_ids.values()))
+        self.room_cache.put(room_id, name, user_ids)
+        return room_id, list(user_ids)
+
+    def _create_room(self, connection: sqlite3.Connection, creator_id: int, name: str, member_ids):
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO rooms (name, created_by) VALUES (?, ?)", (name, creator_id))
+        room_id = cursor.lastrowid
+        cursor.executemany("INSERT INTO room_members (room_id, user_id) VALUES (?, ?)", [(room_id, user_id) for user_id in member_ids])
+        return room_id
+
+    #returns {"name": ..., "members": {...}} for a room from the room cache, loading it on a miss
+    #returns None if the room does not exist
+    async def get_room(self, room_id: int):
+        entry = self.room_cache.get(room_id)
+        if entry is not None:
+            return entry
+        generation = self.room_cache.generation
+        row = await self.pool.read(self._get_room, room_id)
+        if row is None:
+            return None
+        name, members = row
+        #only cache what we read if nothing changed in the meantime, otherwise it may already be out of date
+        if generation == self.room_cache.generation:
+            self.room_cache.put(room_id, name, members)
+        return {"name": name, "members": dict.fromkeys(members)}
+
+    def _get_room(self, connection: sqlite3.Connection, room_id: int):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM rooms WHERE room_id = ?", (room_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        cursor.execute("""
+            SELECT u.username FROM room_members rm
+            JOIN users u ON rm.user_id = u.user_id
+            WHERE rm.room_id = ?
+        """, (room_id,))
+        return row[0], [member[0] for member in cursor.fetchall()]
+
+    #adds users to a room, returns the usernames that were added (existing users that weren't members yet)
+    async def add_room_members(self, room_id: int, usernames):
+        room = await self.get_room(room_id)
+        if room is None:
+            return []
+        user_ids = {}
+        for username in usernames:
+            if username in room["members"] or len(room["members"]) + len(user_ids) >= ROOM_MAX_MEMBERS:
+                continue
+            user_id = await self.get_user_id(username)
+            if user_id is not None:
+                user_ids[username] = user_id
+        if not user_ids:
+            return []
+        await self.pool.write(self._add_room_members, room_id, list(user_ids.values()))
+        self.room_cache.members_added(room_id, user_ids)
+        return list(user_ids)
+
+    def _add_room_members(self, connection: sqlite3.Connection, room_id: int, user_ids):
+        cursor = connection.cursor()
+        cursor.executemany("INSERT OR IGNORE INTO room_members (room_id, user_id) VALUES (?, ?)", [(room_id, user_id) for user_id in user_ids])
+
+    async def leave_room(self, room_id: int, username: str) -> bool:
+        user_id = await self.get_user_id(username)
+        if user_id is None:
             return False
-    
-    #closes the database connection when the server is closed
+        left = await self.pool.write(self._leave_room, room_id, user_id)
+        if left:
+            self.room_cache.member_left(room_id, username)
+        return left
+
+    def _leave_room(self, connection: sqlite3.Connection, room_id: int, user_id: int) -> bool:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM room_members WHERE room_id = ? AND user_id = ?", (room_id, user_id))
+        return cursor.rowcount > 0
+
+    #the rooms a user is a member of
+    async def get_user_rooms(self, username: str):
+        user_id = await self.get_user_id(username)
+        if user_id is None:
+            return []
+        rows = await self.pool.read(self._get_user_rooms, user_id)
+        return [{'room_id': row[0], 'name': row[1]} for row in rows]
+
+    def _get_user_rooms(self, connection: sqlite3.Connection, user_id: int):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT r.room_id, r.name FROM room_members rm
+            JOIN rooms r ON rm.room_id = r.room_id
+            WHERE rm.user_id = ?
+            ORDER BY r.room_id
+        """, (user_id,))
+        return cursor.fetchall()
+
+    #queues a room message to be saved (once, for every member), see MessageWriter
+    #returns the message_id the same way save_message does, members are the users told about it in "async" mode
+    async def save_room_message(self, room_id: int, sender: str, content: str, members=(), client_id=None):
+        sender_id = await self.get_user_id(sender)
+        if sender_id is None:
+            return None
+        saved = {"from": sender, "room_id": room_id, "client_id": client_id, "notify": list(members)}
+        return await self.message_writer.enqueue(sender_id, None, content, room_id=room_id, saved=saved)
+
+    #returns one page of a room's history, oldest message first (same paging as get_conversation)
+    async def get_room_messages(self, room_id: int, limit: int = HISTORY_PAGE_SIZE, before_id: int = None, after_id: int = None):
+        rows = await self.pool.read(self._get_room_messages, room_id, limit, before_id, after_id)
+        return [{
+            'message_id': row[0],
+            'room_id': room_id,
+            'sender': row[1],
+            'content': row[2],
+            'timestamp': row[3]
+        } for row in rows]
+
+    def _get_room_messages(self, connection: sqlite3.Connection, room_id: int, limit: int, before_id, after_id):
+        cursor = connection.cursor()
+        lower = after_id if after_id is not None else 0
+        upper = before_id if before_id is not None else 2 ** 63 - 1
+        order = "ASC" if after_id is not None else "DESC"
+        cursor.execute(f"""
+            SELECT m.message_id, u.username, m.content, m.timestamp
+            FROM room_messages m
+            JOIN users u ON m.sender_id = u.user_id
+            WHERE m.room_id = ? AND m.message_id > ? AND m.message_id < ?
+            ORDER BY m.message_id {order}
+            LIMIT ?
+        """, (room_id, lower, upper, limit))
+        rows = cursor.fetchall()
+        if order == "DESC":
+            rows.reverse()
+        return rows
+
     def close(self):
-        self.connection.close()
+        self.pool.close()
+
+db = Database(DATABASE_PATH, archive_path=ARCHIVE_PATH)
+metrics.sampled("chat_db_commits_total", "Write transactions committed", lambda: db.pool.commits, "counter")
+metrics.sampled("chat_messages_saved_total", "Chat messages saved", lambda: db.message_writer.written, "counter")
+metrics.sampled("chat_message_batches_total", "Batches of chat messages saved", lambda: db.message_writer.batches, "counter")
+metrics.sampled("chat_message_queue_depth", "Chat messages waiting to be saved", lambda: db.message_writer.depth)
+
+
+#keeps the messages table small: every ARCHIVE_INTERVAL seconds, messages older than ARCHIVE_AFTER_DAYS are moved into the archive
+#(see Database.archive_messages), a chunk at a time with a short pause in between so new messages get saved meanwhile
+class MessageArchiver:
+    def __init__(self, db: Database, interval: float = 3600, after_days: float = 30, segment_size: int = 500, chunk_size: int = 5000):
+        self.db = db
+        self.interval = interval
+        self.after_days = after_days
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.task = None
+        #messages moved into the archive so far
+        self.archived = 0
+
+    def start(self):
+        if self.task is None and self.interval > 0:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.archive()
+            except sqlite3.Error as e:
+                #try again next time
+                log.error("failed to archive messages", extra={"error": str(e)})
+            await asyncio.sleep(self.interval)
+
+    #archives everything that is old enough, returns how many messages were moved
+    async def archive(self) -> int:
+        before = datetime.now(timezone.utc) - timedelta(days=self.after_days)
+        total = 0
+        while True:
+            archived = await self.db.archive_messages(before, self.segment_size, self.chunk_size)
+            if archived == 0:
+                break
+            total += archived
+            self.archived += archived
+            await asyncio.sleep(0.05)
+        if total:
+            log.info("archived messages", extra={"messages": total})
+        return total
+
+archiver = MessageArchiver(db, ARCHIVE_INTERVAL, ARCHIVE_AFTER_DAYS, ARCHIVE_SEGMENT_SIZE, ARCHIVE_CHUNK_SIZE)
+metrics.sampled("chat_archived_messages_total", "Messages moved into the archive", lambda: archiver.archived, "counter")
+
+#---Wire Format---
+#a client picks how frames are encoded with the WebSocket subprotocol header, e.g.
+#  new WebSocket(url, ["chat.msgpack", "chat.json"])
+#  "chat.msgpack": MessagePack binary frames (smaller and faster to parse), only offered if msgpack is installed
+#  "chat.json": JSON text frames
+#both of these may carry a batch: a frame can be a list of events instead of one event, in either direction
+#clients that don't ask for a subprotocol get the original format: one JSON event per text frame
+
+#compact JSON, with orjson when it is installed (several times faster than the json module)
+if orjson is not None:
+    def json_dumps(payload) -> str:
+        return orjson.dumps(payload).decode()
+    json_loads = orjson.loads
+else:
+    def json_dumps(payload) -> str:
+        return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+    json_loads = json.loads
+
+
+class JsonCodec:
+    subprotocol = None #the original format, no subprotocol
+    binary = False
+    batching = False
+
+    def encode(self, payload: dict) -> str:
+        return json_dumps(payload)
+
+    def decode(self, data):
+        return json_loads(data)
+
+    #joins frames that are already encoded into one JSON list, without decoding them again
+    def encode_batch(self, frames) -> str:
+        return "[" + ",".join(frames) + "]"
+
+
+class BatchJsonCodec(JsonCodec):
+    subprotocol = "chat.json"
+    batching = True
+
+
+class MsgpackCodec:
+    subprotocol = "chat.msgpack"
+    binary = True
+    batching = True
+
+    def encode(self, payload: dict) -> bytes:
+        return msgpack.packb(payload)
+
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+    #a MessagePack list is a header with its length followed by the items, so encoded frames can just be glued together
+    def encode_batch(self, frames) -> bytes:
+        count = len(frames)
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 65536:
+            header = b"\xdc" + count.to_bytes(2, "big")
+        else:
+            header = b"\xdd" + count.to_bytes(4, "big")
+        return header + b"".join(frames)
+
+
+LEGACY_CODEC = JsonCodec()
+#in order of preference
+CODECS = [codec for codec in (MsgpackCodec() if msgpack is not None else None, BatchJsonCodec()) if codec is not None]
+
+#picks the best format that both the client and the server support
+def choose_codec(subprotocols) -> JsonCodec:
+    for codec in CODECS:
+        if codec.subprotocol in subprotocols:
+            return codec
+    return LEGACY_CODEC
+
+
+#waits for the next frame from a client and returns the events in it (a batch frame holds several)
+async def receive_events(websocket: WebSocket, codec) -> list:
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    data = message.get("bytes") if message.get("bytes") is not None else message.get("text")
+    events = codec.decode(data)
+    return events if isinstance(events, list) else [events]
+
+
+#---Broker---
+#each uvicorn worker is a separate process with its own ConnectionManager, so a worker only knows the users connected to it
+#the broker passes small JSON messages between the workers, so a message to a user on another worker still arrives
+#any broker has to offer these three methods. To use something else (e.g. Redis), subclass Broker and return it from make_broker
+class Broker:
+    def __init__(self):
+        #called with every message that comes in from another worker
+        self.handler = None
+
+    async def start(self, handler):
+        self.handler = handler
+
+    #send a message to every other worker. Must not wait, it is called from code that can't await
+    def publish(self, message: dict):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+#only one worker: there is no one to talk to
+class LocalBroker(Broker):
+    def publish(self, message: dict):
+        pass
+
+
+#lets the workers on one machine talk through a Unix-domain socket
+#the first worker to grab the lock file becomes the "hub": it listens on the socket and forwards every line it gets to all the others
+#the other workers connect to the hub. If the hub dies, its lock is released, and one of them takes over
+#messages are sent as one JSON object per line
+class UnixSocketBroker(Broker):
+    def __init__(self, path: str, retry_interval: float = 0.5):
+        super().__init__()
+        self.path = path
+        self.retry_interval = retry_interval
+        self.lock_file = None
+        self.server = None
+        #hub: the connected workers, worker: the connection to the hub
+        self.peers = set()
+        self.hub = None
+        self.task = None
+        self.stopping = False
+
+    async def start(self, handler):
+        await super().start(handler)
+        self.task = asyncio.create_task(self.run())
+
+    def publish(self, message: dict):
+        line = (json_dumps(message) + "\n").encode()
+        if self.server is not None:
+            for peer in list(self.peers):
+                peer.write(line)
+        elif self.hub is not None:
+            self.hub.write(line)
+
+    async def stop(self):
+        self.stopping = True
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.hub is not None:
+            self.hub.close()
+        if self.server is not None:
+            self.server.close()
+            for peer in list(self.peers):
+                peer.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        if self.lock_file is not None:
+            self.lock_file.close()
+
+    #returns True if this worker got the hub lock
+    def try_lock(self) -> bool:
+        #imported here because fcntl only exists on Unix, and the server should still start on Windows with the local broker
+        import fcntl
+        lock_file = open(self.path + ".lock", "w")
+        try:
+            #LOCK_NB: give up right away instead of waiting if another worker holds it
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    async def run(self):
+        while not self.stopping:
+            if self.try_lock():
+                #we are the hub now. A socket file left behind by an old hub has to go before we can listen on the path
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                self.server = await asyncio.start_unix_server(self.handle_peer, path=self.path)
+                self.handler({"type": "connected"})
+                #the hub keeps serving until the server shuts down
+                await asyncio.Event().wait()
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                #the hub is not listening (yet), try again in a moment
+                await asyncio.sleep(self.retry_interval)
+                continue
+            self.hub = writer
+            self.handler({"type": "connected"})
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self.handler(json_loads(line))
+            except ConnectionError:
+                pass
+            #the hub went away. Forget everything we heard through it and look for the new hub
+            self.hub = None
+            writer.close()
+            self.handler({"type": "disconnected"})
+
+    #(hub only) reads the lines from one worker and passes them on to everyone else
+    async def handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.peers.add(writer)
+        worker_id = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for peer in list(self.peers):
+                    if peer is not writer:
+                        peer.write(line)
+                message = json_loads(line)
+                worker_id = message.get("origin", worker_id)
+                self.handler(message)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.peers.discard(writer)
+            writer.close()
+        #let everyone know the users of that worker are gone
+        if worker_id is not None:
+            message = {"type": "worker_gone", "origin": worker_id}
+            self.publish(message)
+            self.handler(message)
+
+
+#picks the broker from BROKER_URL
+def make_broker(url: str) -> Broker:
+    if url in ("", "local"):
+        return LocalBroker()
+    if url.startswith("unix://"):
+        return UnixSocketBroker(url[len("unix://"):])
+    raise ValueError(f"Unknown broker: {url}")
 
-db = Database()
 
 #---WebSocket Manager---
 
+#the frames waiting to be sent to one connection, and the task that sends them
+#nothing else ever awaits this client's socket, so a slow or stalled client only slows down its own queue
+#when the queue is full, the overflow policy decides what happens:
+#  "drop_oldest": throw away the oldest waiting frame to make room
+#  "disconnect": close the connection, the client can reconnect and reload
+#  "spill": drop the new frame and send the client one "resync" event once it has caught up
+#           (chat messages are already saved in the database, so the client can fetch what it missed)
+class Outbox:
+    def __init__(self, websocket: WebSocket, max_size: int = 256, policy: str = "drop_oldest", send_timeout: float = 5, on_close=None, codec=LEGACY_CODEC, max_batch: int = 64):
+        if policy not in ("drop_oldest", "disconnect", "spill"):
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.websocket = websocket
+        #how frames for this client are encoded, see Wire Format
+        self.codec = codec
+        self.max_batch = max_batch
+        self.policy = policy
+        self.send_timeout = send_timeout
+        #called once the writer task stops because the socket is dead or was disconnected
+        self.on_close = on_close
+        #every item is a frame encoded with self.codec, or None to tell the writer to stop
+        self.queue: asyncio.Queue = asyncio.Queue(max_size)
+        self.dropped = 0
+        self.needs_resync = False
+        self.closing = False
+        self.close_socket = False
+        self.task = asyncio.create_task(self.run())
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    #queue a frame without waiting. Returns False if the frame was not queued
+    def put(self, frame) -> bool:
+        if self.closing:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            pass
+        self.dropped += 1
+        if self.policy == "drop_oldest":
+            self.queue.get_nowait()
+            self.queue.put_nowait(frame)
+            return True
+        if self.policy == "disconnect":
+            self.close()
+        else:
+            self.needs_resync = True
+        return False
+
+    #stop sending and close the socket, whatever is still waiting is thrown away
+    def close(self):
+        self.stop(close_socket=True)
+
+    #stop sending but leave the socket alone (its handler is already closing it)
+    def cancel(self):
+        self.stop(close_socket=False)
+
+    #the writer is stopped with a None in the queue rather than task.cancel(),
+    #because asyncio.wait_for can swallow a cancel that arrives just as a send finishes
+    def stop(self, close_socket: bool):
+        if self.closing:
+            return
+        self.closing = True
+        self.close_socket = close_socket
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def run(self):
+        send = self.websocket.send_bytes if self.codec.binary else self.websocket.send_text
+        stopping = False
+        try:
+            while not stopping:
+                frame = await self.queue.get()
+                if frame is None:
+                    break
+                #if the client understands batches, everything else that is waiting goes out in the same frame
+                if self.codec.batching and not self.queue.empty():
+                    frames = [frame]
+                    while len(frames) < self.max_batch and not self.queue.empty():
+                        frame = self.queue.get_nowait()
+                        if frame is None:
+                            stopping = True
+                            break
+                        frames.append(frame)
+                    frame = self.codec.encode_batch(frames)
+                await asyncio.wait_for(send(frame), self.send_timeout)
+                #the client caught up after frames were spilled, tell it to fetch what it missed
+                if self.needs_resync and self.queue.empty():
+                    self.needs_resync = False
+                    self.queue.put_nowait(self.codec.encode({"type": "resync"}))
+        except Exception:
+            #the socket is broken or the client is too slow
+            self.closing = True
+            self.close_socket = True
+        if not self.close_socket:
+            return
+        try:
+            await asyncio.wait_for(self.websocket.close(), self.send_timeout)
+        except Exception:
+            pass
+        if self.on_close is not None:
+            self.on_close()
+
+
 #keeps track of: which users are online and their WebSocket connections
 #handles connecting, disconnecting and sending updates
 #without this, our server would not know who is online
+#nothing is sent directly: every frame goes into the connection's Outbox, so sending never waits on a client
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, send_timeout: float = 5, queue_size: int = 256, overflow_policy: str = "drop_oldest"):
         self.active_connections: Dict[str, WebSocket] = {} #connection_id: WebSocket after two users connect
         self.user_connections: Dict[str, str] = {}  #username: connection_id
+        self.connection_users: Dict[str, str] = {}  #connection_id: username (the other way around)
+        self.outboxes: Dict[str, Outbox] = {}  #connection_id: Outbox
+        #users connected to other workers, username: id of their worker
+        self.remote_users: Dict[str, str] = {}
+        #message type: function, for broker messages handled outside the manager (see on())
+        self.broker_handlers = {}
+        #connection_id: when we last heard from it (event loop time), see run_heartbeat
+        self.last_seen: Dict[str, float] = {}
+        #connections that were pinged and have not answered yet
+        self.pinged = set()
+        self.heartbeat_task = None
+        #called with the username of a connection the server closed: silent too long, or too slow to keep up (see closed)
+        self.on_evict = None
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.broker: Broker = LocalBroker()
+        self.send_timeout = send_timeout
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        #frames dropped by connections that have already gone away
+        self.closed_dropped = 0
 
     #when a user connects
     #with async, python can start a task, then go do something else while waiting for the slow task to finish
@@ -324,14 +2419,28 @@ class ConnectionManager:
         #await can only be used inside an async def. 
         #await means let other code run, but pause here and wait for the result. Waiting for messages is slow, otherwise the server might completely freeze
         #send real-time messages freely - the chat-pipe is open
-        await websocket.accept()
-        print(f"WebSocket connected for {username}")
+        #the client lists the wire formats it supports in the subprotocol header, we answer with the one we picked
+        codec = choose_codec(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=codec.subprotocol)
+        log.info("websocket connected", extra={"user": username, "subprotocol": codec.subprotocol})
+        return self.register(websocket, username, codec)
+
+    #adds an already accepted WebSocket and starts its writer task
+    def register(self, websocket: WebSocket, username: str, codec=LEGACY_CODEC) -> str:
         #create a random unique ID for this connection
         connection_id = str(uuid.uuid4())
         #link connection_id to WebSocket
         self.active_connections[connection_id] = websocket
         #link username to connection_id
         self.user_connections[username] = connection_id
+        self.connection_users[connection_id] = username
+        self.outboxes[connection_id] = Outbox(
+            websocket, self.queue_size, self.overflow_policy, self.send_timeout,
+            on_close=lambda: self.closed(connection_id, username),
+            codec=codec, max_batch=WS_BATCH_MAX
+        )
+        self.touch(connection_id)
+        self.publish({"type": "presence", "username": username, "online": True})
         return connection_id
 
     #when a user disconnects (closes browser/tab)
@@ -339,26 +2448,654 @@ class ConnectionManager:
         #remove the WebSocket object 
         if connection_id in self.active_connections:
             del self.active_connections[connection_id]
+        self.connection_users.pop(connection_id, None)
+        self.last_seen.pop(connection_id, None)
+        self.pinged.discard(connection_id)
+        outbox = self.outboxes.pop(connection_id, None)
+        if outbox is not None:
+            self.closed_dropped += outbox.dropped
+            outbox.cancel()
         #remove their connection_id mapping
         #server now knows they are offline
-        if username in self.user_connections:
+        #only if it still points at this connection: if they already reconnected, the new connection must stay
+        if self.user_connections.get(username) == connection_id:
             del self.user_connections[username]
+            self.publish({"type": "presence", "username": username, "online": False})
+
+    #the outbox closed the socket itself (send timeout or the "disconnect" overflow policy)
+    #it is forgotten and reported like an evicted connection, so friends learn the user went offline
+    def closed(self, connection_id: str, username: str):
+        #already gone: the handler or the heartbeat removed it first and took care of that
+        if connection_id not in self.outboxes:
+            return
+        self.disconnect(connection_id, username)
+        if self.on_evict is not None:
+            self.on_evict(username)
+
+    #is the user connected to this worker or any other one
+    def is_online(self, username: str) -> bool:
+        return username in self.user_connections or username in self.remote_users
+
+    #everyone online, on every worker
+    def online_users(self):
+        return list(self.user_connections.keys() | self.remote_users.keys())
 
-    #show online user list
-    async def broadcast_user_list(self):
-        #get a list of all usernames who are currently online
-        online_users = list(self.user_connections.keys())
-        #for every online user, send them this json message
-        for connection in self.active_connections.values():
-            print(f"Broadcasting user list: {online_users}")
-            await connection.send_json({
-                "type": "user_list",
-                "users": online_users
-            })
+    #---heartbeats---
+    #a client whose network died without closing the socket never raises WebSocketDisconnect,
+    #so every connection that goes quiet is pinged, and one that stays quiet is closed
+    #the client answers a "ping" event with a "pong" event, but any frame it sends counts as a sign of life
+
+    #the connection just sent something
+    def touch(self, connection_id: str):
+        if connection_id in self.outboxes:
+            self.last_seen[connection_id] = asyncio.get_running_loop().time()
+            self.pinged.discard(connection_id)
+
+    def start_heartbeat(self, interval: float, timeout: float):
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.create_task(self.run_heartbeat(interval, timeout))
+
+    async def stop_heartbeat(self):
+        if self.heartbeat_task is None:
+            return
+        self.heartbeat_task.cancel()
+        try:
+            await self.heartbeat_task
+        except asyncio.CancelledError:
+            pass
+        self.heartbeat_task = None
+
+    async def run_heartbeat(self, interval: float, timeout: float):
+        loop = asyncio.get_running_loop()
+        #check a few times per interval, so a connection is pinged or closed soon after it is due
+        period = min(interval, timeout) / 4
+        while True:
+            await asyncio.sleep(period)
+            now = loop.time()
+            for connection_id, seen in list(self.last_seen.items()):
+                idle = now - seen
+                if idle >= timeout:
+                    self.evict(connection_id)
+                elif idle >= interval and connection_id not in self.pinged:
+                    self.pinged.add(connection_id)
+                    self.send(connection_id, {"type": "ping"})
+
+    #closes a connection that stopped answering and forgets it right away
+    #(its handler may not hear about it until the socket finally times out)
+    def evict(self, connection_id: str):
+        username = self.connection_users.get(connection_id)
+        outbox = self.outboxes.get(connection_id)
+        if username is None or outbox is None:
+            return
+        log.warning("closing silent connection", extra={"user": username})
+        outbox.close()
+        self.disconnect(connection_id, username)
+        if self.on_evict is not None:
+            self.on_evict(username)
+
+    #---talking to the other workers---
+    async def start_broker(self, broker: Broker):
+        self.broker = broker
+        await broker.start(self.handle_broker_message)
+
+    async def stop_broker(self):
+        await self.broker.stop()
+        self.broker = LocalBroker()
+
+    def publish(self, message: dict):
+        message["origin"] = self.worker_id
+        self.broker.publish(message)
+
+    #lets other parts of the server react to their own kind of broker message
+    def on(self, kind: str, handler):
+        self.broker_handlers[kind] = handler
+
+    #handles a message that came from another worker (or from the broker itself)
+    def handle_broker_message(self, message: dict):
+        kind = message["type"]
+        origin = message.get("origin")
+        if origin == self.worker_id:
+            return
+        #a frame for one of our users
+        if kind == "deliver":
+            connection_id = self.user_connections.get(message["to"])
+            if connection_id is not None:
+                self.send(connection_id, message["payload"])
+        #a frame for several users, some of them may be ours
+        elif kind == "deliver_many":
+            self.send_to_local_users(message["to"], message["payload"])
+        #someone connected to or disconnected from another worker
+        elif kind == "presence":
+            if message["online"]:
+                self.remote_users[message["username"]] = origin
+            elif self.remote_users.get(message["username"]) == origin:
+                del self.remote_users[message["username"]]
+        #a worker (re)joined and wants to know who is online everywhere
+        elif kind == "hello":
+            self.publish({"type": "presence_sync", "users": list(self.user_connections)})
+        elif kind == "presence_sync":
+            for username in message["users"]:
+                self.remote_users[username] = origin
+        #a worker stopped, so its users are offline
+        elif kind == "worker_gone":
+            self.remote_users = {username: worker for username, worker in self.remote_users.items() if worker != origin}
+        #we just joined: start from a clean slate and ask everyone who is online
+        elif kind == "connected":
+            self.remote_users.clear()
+            self.publish({"type": "hello"})
+            self.publish({"type": "presence_sync", "users": list(self.user_connections)})
+        elif kind == "disconnected":
+            self.remote_users.clear()
+        elif kind in self.broker_handlers:
+            self.broker_handlers[kind](message)
+
+    #total number of frames waiting to be sent, over all connections
+    @property
+    def queue_depth(self) -> int:
+        return sum(outbox.depth for outbox in self.outboxes.values())
+
+    #total number of frames thrown away because a client could not keep up
+    @property
+    def dropped_messages(self) -> int:
+        return self.closed_dropped + sum(outbox.dropped for outbox in self.outboxes.values())
+
+    #queue a payload for one connection, encoded in that connection's wire format. Returns False if it was not queued
+    def send(self, connection_id: str, payload: dict) -> bool:
+        outbox = self.outboxes.get(connection_id)
+        if outbox is None:
+            return False
+        return outbox.put(outbox.codec.encode(payload))
+
+    #queue a payload for one user, if they are online. Returns True if it was queued
+    #users connected to another worker get it through the broker
+    def send_to_user(self, username: str, payload: dict) -> bool:
+        connection_id = self.user_connections.get(username)
+        if connection_id is not None:
+            return self.send(connection_id, payload)
+        if username in self.remote_users:
+            #the payload is sent as it is, the other worker encodes it in the user's wire format
+            self.publish({"type": "deliver", "to": username, "payload": payload})
+            return True
+        return False
+
+    #queues the same payload for several users (e.g. the members of a room)
+    #the payload is encoded once per wire format (not once per user), and each connection's writer task sends it on its own time
+    #users on other workers get it through a single broker message, however many of them there are
+    #returns how many users it was queued for
+    def send_to_users(self, usernames, payload: dict) -> int:
+        queued = self.send_to_local_users(usernames, payload)
+        remote = [username for username in usernames if username in self.remote_users and username not in self.user_connections]
+        if remote:
+            self.publish({"type": "deliver_many", "to": remote, "payload": payload})
+        fanout_frames.inc(payload["type"], amount=queued + len(remote))
+        return queued + len(remote)
+
+    def send_to_local_users(self, usernames, payload: dict) -> int:
+        outboxes = []
+        for username in usernames:
+            connection_id = self.user_connections.get(username)
+            if connection_id is not None:
+                outboxes.append(self.outboxes[connection_id])
+        return self.queue_for(outboxes, payload)
+
+    #encodes the payload once per wire format and queues it on every outbox, returns how many took it
+    def queue_for(self, outboxes, payload: dict) -> int:
+        frames = {}
+        queued = 0
+        for outbox in outboxes:
+            codec = outbox.codec
+            if codec.subprotocol not in frames:
+                frames[codec.subprotocol] = codec.encode(payload)
+            if outbox.put(frames[codec.subprotocol]):
+                queued += 1
+        return queued
+
+manager = ConnectionManager(SEND_TIMEOUT, SEND_QUEUE_SIZE, SEND_OVERFLOW_POLICY)
+metrics.sampled("chat_ws_connections", "Open WebSocket connections", lambda: len(manager.outboxes))
+metrics.sampled("chat_online_users", "Users online on any worker", lambda: len(manager.online_users()))
+metrics.sampled("chat_send_queue_depth", "Frames waiting in the send queues of all connections", lambda: manager.queue_depth)
+metrics.sampled("chat_dropped_frames_total", "Frames dropped because a client could not keep up", lambda: manager.dropped_messages, "counter")
+
+#every worker has its own social graph cache: when friendships change on one worker, the others drop their copies of those users
+def social_graph_changed(usernames):
+    manager.publish({"type": "social_graph_changed", "users": usernames})
+
+def invalidate_social_graph(message: dict):
+    for username in message["users"]:
+        db.social_graph.invalidate(username)
+
+db.social_graph.on_change = social_graph_changed
+manager.on("social_graph_changed", invalidate_social_graph)
+
+#same for the room member lists
+def room_changed(room_id: int):
+    manager.publish({"type": "room_changed", "room_id": room_id})
+
+db.room_cache.on_change = room_changed
+manager.on("room_changed", lambda message: db.room_cache.invalidate(message["room_id"]))
+
+#in "async" mode live messages go out before they have a message_id, so once a batch is committed
+#everyone involved gets one "messages_saved" event listing the ids of their messages in it (to move their sync and read cursors)
+def messages_saved(saved):
+    events: Dict[str, list] = {}
+    for message, message_id in saved:
+        if "to" in message:
+            ephemeral.message_saved(message["from"], message["to"], message_id)
+        entry = {"message_id": message_id, **{key: value for key, value in message.items() if key != "notify" and value is not None}}
+        for username in message["notify"]:
+            events.setdefault(username, []).append(entry)
+    for username, messages in events.items():
+        manager.send_to_user(username, {"type": "messages_saved", "messages": messages})
+
+db.message_writer.on_saved = messages_saved
+
+#---Presence---
+#tells users which of their friends are online
+#instead of sending everyone the full list of online users on every connect/disconnect, a user gets:
+#  one "user_list" with their online friends when they connect
+#  "presence_delta" events after that, listing only the friends who joined or left
+#changes are collected for PRESENCE_DEBOUNCE_MS first, so someone who reconnects quickly (e.g. after a deploy) sends nothing at all
+class PresenceManager:
+    def __init__(self, manager: ConnectionManager, db: Database, debounce_ms: int = 250):
+        self.manager = manager
+        self.db = db
+        self.debounce = debounce_ms / 1000
+        #username: whether they are online now, for everyone who changed during the current window
+        self.pending: Dict[str, bool] = {}
+        #users that their friends were last told are online
+        self.announced = set()
+        self.flush_task = None
+
+    #send the new user their online friends, then let the friends know about them
+    async def user_connected(self, username: str):
+        friends = await self.db.get_friends_list(username)
+        self.manager.send_to_user(username, {
+            "type": "user_list",
+            "users": [friend for friend in friends if self.manager.is_online(friend)]
+        })
+        self.changed(username, True)
+
+    def user_disconnected(self, username: str):
+        #they may already have opened a new connection
+        self.changed(username, self.manager.is_online(username))
+
+    def changed(self, username: str, online: bool):
+        self.pending[username] = online
+        #the first change of a window starts the timer, later ones are just collected
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.debounce)
+        #changes from here on belong to the next window
+        self.flush_task = None
+        pending, self.pending = self.pending, {}
+
+        #recipient: the presence_delta they will get
+        deltas: Dict[str, dict] = {}
+        for username, online in pending.items():
+            #joined and left again (or the other way around) inside one window, nothing to tell
+            if online == (username in self.announced):
+                continue
+            if online:
+                self.announced.add(username)
+            else:
+                self.announced.discard(username)
+            key = "joined" if online else "left"
+            for friend in await self.db.get_friends_list(username):
+                if self.manager.is_online(friend):
+                    delta = deltas.setdefault(friend, {"type": "presence_delta", "joined": [], "left": []})
+                    delta[key].append(username)
+
+        for friend, delta in deltas.items():
+            self.manager.send_to_user(friend, delta)
+        presence_deltas.inc(amount=len(deltas))
+
+    #two users just became friends (or stopped being friends), so they now see (or stop seeing) each other
+    def friendship_changed(self, user1: str, user2: str, friends: bool):
+        key = "joined" if friends else "left"
+        for username, other in ((user1, user2), (user2, user1)):
+            if self.manager.is_online(other):
+                delta = {"type": "presence_delta", "joined": [], "left": []}
+                delta[key].append(other)
+                self.manager.send_to_user(username, delta)
+
+presence = PresenceManager(manager, db, PRESENCE_DEBOUNCE_MS)
+#friends of a user whose connection went silent are told right away
+manager.on_evict = presence.user_disconnected
+
+
+#who is online lives in memory (ConnectionManager), connecting and disconnecting never write to the database
+#the users.online column is brought up to date every PRESENCE_SNAPSHOT_INTERVAL seconds instead,
+#writing only the users whose status changed since the last snapshot, all in one transaction
+class PresenceSnapshot:
+    def __init__(self, manager: ConnectionManager, db: Database, interval: float = 30):
+        self.manager = manager
+        self.db = db
+        self.interval = interval
+        #usernames the database currently says are online (None until it is first read)
+        self.saved = None
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    #stops the background task and saves one last snapshot
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        await self.save()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save()
+            except sqlite3.Error as e:
+                #try again with the next snapshot
+                log.error("failed to save presence snapshot", extra={"error": str(e)})
+
+    async def save(self):
+        if self.saved is None:
+            self.saved = set(await self.db.get_online_users())
+        online = set(self.manager.online_users())
+        changes = {username: True for username in online - self.saved}
+        changes.update((username, False) for username in self.saved - online)
+        if changes:
+            await self.db.save_presence(changes)
+        self.saved = online
+
+presence_snapshot = PresenceSnapshot(manager, db, PRESENCE_SNAPSHOT_INTERVAL)
+
+
+#---Ephemeral events---
+#typing indicators and read receipts are only forwarded, never stored as events
+#like presence, they are collected for EPHEMERAL_WINDOW_MS and only the latest one per (sender, recipient) goes out:
+#  "typing": a burst of keystrokes becomes one indicator, and it is only repeated every TYPING_TTL / 2 while the typing goes on
+#            typing and stopping inside one window sends nothing at all
+#  "read": only the highest message_id is sent, receipts for older messages than one already sent are dropped
+#read receipts are also remembered as the reader's last read message, saved every READ_CURSOR_SAVE_INTERVAL seconds in one transaction
+#a receipt is only for a message of the conversation: it is checked against the newest message_id this worker saw saved,
+#and only receipts past that are looked up in the database, all together when the window is flushed
+class EphemeralEvents:
+    def __init__(self, manager: ConnectionManager, db: Database, window_ms: int = 200, typing_ttl: float = 6, save_interval: float = 5, max_cursors: int = 100000):
+        self.manager = manager
+        self.db = db
+        self.window = window_ms / 1000
+        self.typing_ttl = typing_ttl
+        self.save_interval = save_interval
+        #(sender, recipient, room_id): whether they are typing, for everything that changed during the current window
+        #recipient is None for a room, room_id is None otherwise
+        self.pending_typing: Dict[tuple, bool] = {}
+        #(sender, recipient, room_id): when the recipients were last told the sender is typing
+        self.typing_sent: Dict[tuple, float] = {}
+        #(reader, other_user): the highest message_id read during the current window
+        self.pending_reads: Dict[tuple, int] = {}
+        #(reader, other_user): the highest message_id sent as a receipt, for the most recent max_cursors pairs
+        #kept after saving too, so a late receipt for an older message is still recognised as stale
+        self.read_cursors: "OrderedDict[tuple, int]" = OrderedDict()
+        self.max_cursors = max_cursors
+        #the pairs in read_cursors that are not saved to the database yet
+        self.unsaved = set()
+        #(user_low, user_high) by username: the newest message_id known to be in their conversation, for the most recent max_cursors pairs
+        #messages saved by other workers are missing, so a receipt past it is looked up before it is thrown away
+        self.last_message_ids: "OrderedDict[tuple, int]" = OrderedDict()
+        self.flush_task = None
+        self.save_task = None
+
+    def start(self):
+        if self.save_task is None:
+            self.save_task = asyncio.create_task(self.run())
+
+    #stops saving in the background and saves the read cursors that are left
+    async def stop(self):
+        if self.save_task is None:
+            return
+        self.save_task.cancel()
+        try:
+            await self.save_task
+        except asyncio.CancelledError:
+            pass
+        self.save_task = None
+        await self.save()
+
+    def typing(self, sender: str, recipient: str = None, room_id: int = None, typing: bool = True):
+        ephemeral_received.inc("typing")
+        if recipient is None and room_id is None:
+            return
+        self.pending_typing[(sender, recipient, room_id)] = typing
+        self.schedule()
+
+    def read(self, reader: str, other_user: str, message_id: int):
+        ephemeral_received.inc("read")
+        key = (reader, other_user)
+        #older than a receipt that was already sent (e.g. from the reader's other tab)
+        if message_id <= self.pending_reads.get(key, self.read_cursors.get(key, 0)):
+            return
+        self.pending_reads[key] = message_id
+        self.schedule()
+
+    #a direct message was saved, so receipts up to it are valid
+    def message_saved(self, sender: str, recipient: str, message_id: int):
+        key = (min(sender, recipient), max(sender, recipient))
+        if message_id > self.last_message_ids.get(key, 0):
+            self.last_message_ids[key] = message_id
+        self.last_message_ids.move_to_end(key)
+        if len(self.last_message_ids) > self.max_cursors:
+            self.last_message_ids.popitem(last=False)
+
+    #a message was sent, so its sender is no longer typing (clients hide the indicator when the message arrives)
+    def message_sent(self, sender: str, recipient: str = None, room_id: int = None):
+        key = (sender, recipient, room_id)
+        self.pending_typing.pop(key, None)
+        self.typing_sent.pop(key, None)
+
+    def schedule(self):
+        #the first event of a window starts the timer, later ones are just collected
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.window)
+        #events from here on belong to the next window
+        self.flush_task = None
+        typing, self.pending_typing = self.pending_typing, {}
+        reads, self.pending_reads = self.pending_reads, {}
+        now = time.monotonic()
+
+        #indicators that expired by themselves are forgotten
+        for key, sent in list(self.typing_sent.items()):
+            if now - sent > self.typing_ttl:
+                del self.typing_sent[key]
+        for key, is_typing in typing.items():
+            sent = self.typing_sent.get(key)
+            if is_typing:
+                #the recipients were told recently enough, their indicator is still showing
+                if sent is not None and now - sent < self.typing_ttl / 2:
+                    continue
+                self.typing_sent[key] = now
+            else:
+                #the recipients were never told (or it already expired), there is nothing to stop
+                if sent is None:
+                    continue
+                del self.typing_sent[key]
+            sender, recipient, room_id = key
+            payload = {"type": "typing", "from": sender, "typing": is_typing}
+            if room_id is None:
+                self.manager.send_to_user(recipient, payload)
+                ephemeral_forwarded.inc("typing")
+            else:
+                room = await self.db.get_room(room_id)
+                if room is not None and sender in room["members"]:
+                    payload["room_id"] = room_id
+                    forwarded = self.manager.send_to_users([member for member in room["members"] if member != sender], payload)
+                    ephemeral_forwarded.inc("typing", amount=forwarded)
+
+        #receipts for messages newer than this worker knows about are checked against the database, in one read
+        unknown = [
+            (reader, other_user) for (reader, other_user), message_id in reads.items()
+            if message_id > self.last_message_ids.get((min(reader, other_user), max(reader, other_user)), 0)
+        ]
+        if unknown:
+            for (reader, other_user), last_message_id in (await self.db.get_last_message_ids(unknown)).items():
+                self.message_saved(reader, other_user, last_message_id)
+
+        for (reader, other_user), message_id in reads.items():
+            key = (reader, other_user)
+            if message_id > self.last_message_ids.get((min(reader, other_user), max(reader, other_user)), 0):
+                self.manager.send_to_user(reader, {"type": "error", "error": "message_id is not a message of this conversation", "event": "read"})
+                continue
+            if message_id <= self.read_cursors.get(key, 0):
+                continue
+            self.read_cursors[key] = message_id
+            self.read_cursors.move_to_end(key)
+            self.unsaved.add(key)
+            #pairs that were saved can go, the database remembers them
+            while len(self.read_cursors) > self.max_cursors:
+                oldest = next(iter(self.read_cursors))
+                if oldest in self.unsaved:
+                    break
+                del self.read_cursors[oldest]
+            self.manager.send_to_user(other_user, {"type": "read", "from": reader, "message_id": message_id})
+            ephemeral_forwarded.inc("read")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            try:
+                await self.save()
+            except sqlite3.Error as e:
+                #the cursors are kept, so they go out with the next save
+                log.error("failed to save read cursors", extra={"error": str(e)})
+
+    async def save(self):
+        if not self.unsaved:
+            return
+        unsaved, self.unsaved = self.unsaved, set()
+        try:
+            await self.db.save_read_cursors({key: self.read_cursors[key] for key in unsaved})
+        except sqlite3.Error:
+            #they go out with the next save
+            self.unsaved |= unsaved
+            raise
+
+ephemeral = EphemeralEvents(manager, db, EPHEMERAL_WINDOW_MS, TYPING_TTL, READ_CURSOR_SAVE_INTERVAL)
+metrics.sampled("chat_read_cursors_pending", "Read receipts waiting to be saved", lambda: len(ephemeral.unsaved))
+
+#---Export/Import---
+#the whole database (users, friendships, rooms, and every message including the archived ones) as NDJSON, one JSON object per line
+#the first line is a header, every other line is one row, e.g. {"type": "message", "message_id": 1, "sender_id": 1, ...}
+#ids are kept as they are, so an export imported into an empty database gives back the same database
+#used by transfer.py (export and import) and the /admin/export endpoint
+
+EXPORT_FORMAT_VERSION = 1
+#record type: (table, columns), in the order they are exported (conversations point at messages, so they come after them)
+EXPORT_TABLES = {
+    "user": ("users", ("user_id", "username", "password")),
+    "friend": ("friends", ("relationship_id", "user_id", "friend_id", "status", "action_user_id")),
+    "room": ("rooms", ("room_id", "name", "created_by", "created_at")),
+    "room_member": ("room_members", ("room_id", "user_id", "joined_at")),
+    "message": ("messages", ("message_id", "sender_id", "recipient_id", "content", "timestamp")),
+    "room_message": ("room_messages", ("message_id", "room_id", "sender_id", "content", "timestamp")),
+    "conversation": ("conversations", (
+        "user_low", "user_high", "last_message_id", "last_timestamp", "unread_low", "unread_high", "read_low", "read_high"
+    )),
+}
+
+
+#opens a connection of its own for an export, in a read transaction that lasts the whole export,
+#so everything comes from the same moment even while the server keeps writing
+def open_export_connection(path: str, archive_path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    connection.execute("BEGIN")
+    return connection
+
+
+#yields every record of the database, each table is read with a single cursor so memory stays flat however big it is
+def export_records(connection: sqlite3.Connection):
+    yield {"type": "header", "version": EXPORT_FORMAT_VERSION, "exported_at": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+    for kind, (table, columns) in EXPORT_TABLES.items():
+        for row in connection.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid"):
+            yield {"type": kind, **dict(zip(columns, row))}
+        #archived messages are exported as ordinary messages, an import puts them back in the messages table
+        if kind == "message":
+            for (data,) in connection.execute("SELECT data FROM archive.segments ORDER BY segment_id"):
+                for row in unpack_segment(data):
+                    yield {"type": kind, **dict(zip(columns, row))}
+
+
+#turns records into chunks of about chunk_size bytes of NDJSON, gzip-compressed if compress is set
+def export_chunks(records, compress: bool = False, chunk_size: int = 1 << 20):
+    #wbits=31 writes a gzip header, so the output is an ordinary .gz file
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = bytearray()
+    for record in records:
+        buffer += json_dumps(record).encode()
+        buffer += b"\n"
+        if len(buffer) >= chunk_size:
+            chunk = compressor.compress(buffer) if compressor else bytes(buffer)
+            buffer.clear()
+            if chunk:
+                yield chunk
+    chunk = compressor.compress(buffer) + compressor.flush() if compressor else bytes(buffer)
+    if chunk:
+        yield chunk
+
+
+#turns one NDJSON line back into (record type, row values in EXPORT_TABLES order), or None for the header
+def import_row(line: bytes):
+    record = json_loads(line)
+    kind = record["type"]
+    if kind == "header":
+        if record.get("version") != EXPORT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported export version: {record.get('version')}")
+        return None
+    if kind not in EXPORT_TABLES:
+        raise ValueError(f"Unknown record type: {kind}")
+    return kind, tuple(record.get(column) for column in EXPORT_TABLES[kind][1])
+
+
+#inserts a batch of rows ({record type: [rows]}) in one transaction, rows that are already there are skipped (so a batch can be repeated)
+def import_batch(connection: sqlite3.Connection, batch: dict):
+    cursor = connection.cursor()
+    for kind, rows in batch.items():
+        table, columns = EXPORT_TABLES[kind]
+        cursor.executemany(f"""
+            INSERT OR IGNORE INTO {table} ({', '.join(columns)})
+            VALUES ({', '.join('?' * len(columns))})
+        """, rows)
+
+
+#before a bulk import: drops every index and trigger, so each row is written once instead of once per index
+#(Database.create_tables puts them back afterwards, see finish_import)
+def drop_indexes(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger') AND sql IS NOT NULL")
+    for kind, name in cursor.fetchall():
+        cursor.execute(f'DROP {kind.upper()} IF EXISTS "{name}"')
+
+
+#after a bulk import: the search index is rebuilt from the messages table in one pass (its triggers were dropped too)
+def finish_import(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+    cursor.execute("DELETE FROM search_backfill")
 
-manager = ConnectionManager()
 
 #---API Endpoints---
+#the largest id (or offset) a request may hold: SQLite integers are 64-bit, a bigger number can't even be passed to a query
+MAX_ID = 2**63 - 1
+#searches read offset + limit results, so that sum has to fit too
+SEARCH_MAX_OFFSET = MAX_ID - SEARCH_MAX_PAGE_SIZE
+
 #to process login
 @app.post("/login")
 async def login(data: LoginRequest):
@@ -368,27 +3105,140 @@ async def login(data: LoginRequest):
     if not username.strip() or not password.strip():
         raise HTTPException(400, "Username and password required")
     
-    cursor = db.connection.cursor()
-    cursor.execute("SELECT password FROM users WHERE username=?", (username,))
-    result = cursor.fetchone()
-    if not result:
+    stored_password = await db.get_password(username)
+    if stored_password is None:
         raise HTTPException(400, "User does not exist")
     
-    stored_password = result[0]
-    if password != stored_password:
+    #checked in the password processes, so the event loop keeps serving everyone else
+    matches, new_hash = await passwords.check(password, stored_password)
+    if not matches:
         raise HTTPException(400, "Incorrect password")
     
-    #add them to the database if username is fine
-    db.add_or_update_user(username, password, online=True)
+    #the stored password is only rewritten when it was plain text or hashed with old settings
+    if new_hash is not None:
+        await db.set_password(username, new_hash)
+    #otherwise nothing to write: they count as online once their WebSocket connects (see PresenceSnapshot)
     #return a success response to the client
     #client can now open a WebSocket connection
     return {"status": "success", "username": username}
 
+#returns one page of messages between two users (see Database.get_conversation)
+#to load older messages, pass the message_id of the oldest message you have as before_id
 @app.get("/get_messages")
-async def get_messages(user1: str, user2: str):
-    messages = db.get_conversation(user1, user2)
+async def get_messages(
+    user1: str,
+    user2: str,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    before_id: int = Query(None, ge=0, le=MAX_ID),
+    after_id: int = Query(None, ge=0, le=MAX_ID),
+):
+    messages = await db.get_conversation(user1, user2, limit, before_id, after_id)
     return messages
 
+#returns one page of the messages sent to a user after since_id, across all conversations
+#keep calling it with the returned last_id while has_more is true to get everything that was missed
+@app.get("/sync")
+async def sync(
+    username: str,
+    since_id: int = Query(0, ge=0, le=MAX_ID),
+    limit: int = Query(SYNC_PAGE_SIZE, ge=1, le=SYNC_MAX_PAGE_SIZE),
+):
+    return await sync_page(username, since_id, limit)
+
+#returns the user's conversations with the last message and unread count of each (see Database.get_inbox)
+@app.get("/get_inbox")
+async def get_inbox(username: str):
+    return await db.get_inbox(username)
+
+#the metrics (see Metrics) in the Prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+#the whole database as NDJSON (see Export/Import), gzip-compressed unless compress=false
+#it includes the password hashes, so it needs ADMIN_TOKEN
+@app.get("/admin/export")
+async def admin_export(compress: bool = True, authorization: str = Header(None)):
+    if not ADMIN_TOKEN or not hmac.compare_digest(authorization or "", f"Bearer {ADMIN_TOKEN}"):
+        raise HTTPException(403, "Not allowed")
+    filename = "chat-export.ndjson" + (".gz" if compress else "")
+    return StreamingResponse(
+        db.export(compress),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+#a snapshot of the server's counters (used by bench_load.py to see what a load run cost)
+#the counters cover this worker only
+@app.get("/stats")
+async def stats():
+    return {
+        "worker": manager.worker_id,
+        "connections": len(manager.outboxes),
+        "online_users": len(manager.online_users()),
+        "send_queue_depth": manager.queue_depth,
+        "dropped_frames": manager.dropped_messages,
+        "message_queue_depth": db.message_writer.depth,
+        "messages_written": db.message_writer.written,
+        "message_batches": db.message_writer.batches,
+        "commits": db.pool.commits,
+        "archived_messages": archiver.archived,
+        "identity_cache": {"hits": db.identity_cache.hits, "misses": db.identity_cache.misses},
+        "social_graph_cache": {"hits": db.social_graph.hits, "misses": db.social_graph.misses},
+    }
+
+#searches the messages the user sent or received (see Database.search_messages)
+#to get the next page, pass the returned next_offset as offset
+@app.get("/search_messages")
+async def search_messages(
+    username: str,
+    q: str,
+    with_user: str = None,
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+):
+    return await search_page(username, q, with_user, limit, offset)
+
+#shared by the /search_messages endpoint and the "search" WebSocket event
+async def search_page(username: str, text: str, with_user, limit: int, offset: int):
+    results = await db.search_messages(username, text, with_user, limit, offset)
+    return {
+        "results": results,
+        "next_offset": offset + len(results),
+        #a full page means there may be more matches
+        "has_more": len(results) == limit
+    }
+
+#the rooms a user is a member of
+@app.get("/get_rooms")
+async def get_rooms(username: str):
+    return await db.get_user_rooms(username)
+
+#returns one page of a room's messages (same paging as /get_messages), only for members of the room
+@app.get("/get_room_messages")
+async def get_room_messages(
+    username: str,
+    room_id: int = Query(ge=0, le=MAX_ID),
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    before_id: int = Query(None, ge=0, le=MAX_ID),
+    after_id: int = Query(None, ge=0, le=MAX_ID),
+):
+    room = await db.get_room(room_id)
+    if room is None or username not in room["members"]:
+        raise HTTPException(404, "Room not found")
+    return await db.get_room_messages(room_id, limit, before_id, after_id)
+
+#shared by the /sync endpoint and the "sync" WebSocket event
+async def sync_page(username: str, since_id: int, limit: int):
+    messages = await db.get_messages_since(username, since_id, limit)
+    return {
+        "messages": messages,
+        #the cursor to pass next time (unchanged if nothing new arrived)
+        "last_id": messages[-1]['message_id'] if messages else since_id,
+        #a full page means there may be more waiting
+        "has_more": len(messages) == limit
+    }
+
 @app.post("/signup")
 async def signup(data: SignupRequest):
     username = data.username
@@ -397,149 +3247,291 @@ async def signup(data: SignupRequest):
         raise HTTPException(400, "Username and password required")
     
     # Check if username already exists
-    cursor = db.connection.cursor()
-    cursor.execute("SELECT 1 FROM users WHERE username=?", (username,))
-    if cursor.fetchone():
+    if await db.get_password(username) is not None:
         raise HTTPException(400, "Username already exists")
     
     if len(password) < 4:  # Simple password length check
         raise HTTPException(400, "Password must be at least 4 characters")
     
-    # Add new user
-    db.add_or_update_user(username, password, online=True)
+    # Add new user (they count as online once their WebSocket connects)
+    #two signups for the same name can race past the check above, only the first one gets in
+    if not await db.add_user(username, await passwords.hash(password)):
+        raise HTTPException(400, "Username already exists")
     return {"status": "success", "username": username}
 
+#the events websocket_chat understands, anything else is timed as "unknown" (so clients can't invent new metric labels)
+WS_EVENT_TYPES = {
+    "ping", "pong", "friend_request", "remove_friend", "message", "get_friends", "get_pending_requests",
+    "sync", "search", "get_inbox", "mark_read", "friend_response",
+    "create_room", "add_room_members", "leave_room", "room_message", "get_rooms", "typing", "read",
+}
+
+#an event that can't be used (e.g. an id that isn't a number): it is answered with an "error" event and skipped
+class BadEvent(Exception):
+    pass
+
+#reads an id (room_id, message_id, ...) from an event
+#ids are always turned into ints, so "1" and 1 are the same room everywhere (the caches are keyed by them)
+def event_id(data: dict, key: str) -> int:
+    try:
+        value = int(data[key])
+    except (KeyError, TypeError, ValueError):
+        raise BadEvent(f"{key} must be a number")
+    if not 0 <= value <= MAX_ID:
+        raise BadEvent(f"{key} is out of range")
+    return value
+
+#reads an optional number (a limit, an offset, ...) from an event, kept between minimum and maximum
+def event_int(data: dict, key: str, default: int, minimum: int = 0, maximum: int = MAX_ID) -> int:
+    try:
+        value = int(data.get(key, default))
+    except (TypeError, ValueError):
+        raise BadEvent(f"{key} must be a number")
+    return max(minimum, min(value, maximum))
+
 #create a WebSocket where clients can connect and talk in real-time
 @app.websocket("/ws/{username}")
 async def websocket_chat(websocket: WebSocket, username: str):
     #accepts connection and saves the user into the list of online users
     #await because accepting a connection can be slow
     connection_id = await manager.connect(websocket, username)
+    #the wire format this client asked for
+    codec = manager.outboxes[connection_id].codec
     try:
-        #sends a WebSocket message to every connected user, telling them about the updated list
-        await manager.broadcast_user_list()
+        #sends the user their online friends, and tells those friends about the user
+        await presence.user_connected(username)
         
         while True:
-            #listen for any incoming JSON messages from the client
+            #listen for any incoming messages from the client
             #server is waiting for a message from the user
-            #the JSON string is automatically turned into a Python dictionary
-            data = await websocket.receive_json()
-
-            #reads the "type" field from the "data" dictionary 
-            if data["type"] == "friend_request":
-                #the recipient of the request
-                recipient = data["recipient"]
-                #create a pending friend request
-                if db.send_friend_request(username, recipient):
-                    #if the recipient is online
-                    if recipient in manager.user_connections:
-                        recipient_ws = manager.active_connections[manager.user_connections[recipient]]
-                        #send the notification to the recipient
-                        await recipient_ws.send_json({
-                            "type": "friend_request_received",
-                            "from": username
+            #every event is turned into a Python dictionary, one frame can hold several events
+            events = await receive_events(websocket, codec)
+            #anything the client sends shows that the connection is still alive
+            manager.touch(connection_id)
+
+            for data in events:
+                started = time.perf_counter()
+                try:
+                    #reads the "type" field from the "data" dictionary 
+                    if data["type"] == "pong":
+                        pass
+
+                    #the client checking that we are still there
+                    elif data["type"] == "ping":
+                        manager.send(connection_id, {"type": "pong"})
+
+                    elif data["type"] == "friend_request":
+                        #the recipient of the request
+                        recipient = data["recipient"]
+                        #create a pending friend request
+                        if await db.send_friend_request(username, recipient):
+                            #if the recipient is online
+                            if manager.is_online(recipient):
+                                #send the notification to the recipient
+                                manager.send_to_user(recipient, {
+                                    "type": "friend_request_received",
+                                    "from": username
+                                })
+
+                    elif data["type"] == "remove_friend":
+                        target_user = data["target"]
+
+                        if await db.remove_friend(username, target_user):
+                            manager.send(connection_id, {
+                                "type": "friend_removed",
+                                "target": target_user
+                            })
+
+                            if manager.is_online(target_user):
+                                manager.send_to_user(target_user, {
+                                    "type": "friend_removed",
+                                    "removed_user": username
+                                })
+
+                            #they no longer see each other online
+                            presence.friendship_changed(username, target_user, False)
+
+
+                    elif data["type"] == "message":
+                        recipient = data["recipient"]
+                        message = data["message"]
+                
+                        #in "sync" mode the id is known right away, otherwise it follows in a "messages_saved" event
+                        message_id = await db.save_message(username, recipient, message, data.get("client_id"))
+                        ephemeral.message_sent(username, recipient)
+                        if message_id is not None:
+                            ephemeral.message_saved(username, recipient, message_id)
+
+                        if manager.is_online(recipient):
+                            received = {"type": "message", "from": username, "message": message}
+                            sent = {"type": "message", "to": recipient, "message": message, "client_id": data.get("client_id")}
+                            if message_id is not None:
+                                received["message_id"] = sent["message_id"] = message_id
+                            manager.send_to_user(recipient, received)
+                            manager.send(connection_id, sent)
+
+                    elif data["type"] == "get_friends":
+                        friends = await db.get_friends_list(username)
+                        manager.send(connection_id, {
+                            "type": "friends_list",
+                            "friends": friends
                         })
 
-            elif data["type"] == "remove_friend":
-                target_user = data["target"]
+                    elif data["type"] == "get_pending_requests":
+                        pending = await db.get_pending_requests(username)
+                        manager.send(connection_id, {
+                            "type": "pending_requests",
+                            "requests": pending
+                        }) 
 
-                if db.remove_friend(username, target_user):
-                    await websocket.send_json({
-                        "type": "friend_removed",
-                        "target": target_user
-                    })
+                    #catching up on messages that arrived while the user was offline (see /sync)
+                    elif data["type"] == "sync":
+                        limit = event_int(data, "limit", SYNC_PAGE_SIZE, 1, SYNC_MAX_PAGE_SIZE)
+                        page = await sync_page(username, event_int(data, "since_id", 0), limit)
+                        manager.send(connection_id, {"type": "sync", **page})
 
-                    if target_user in manager.user_connections:
-                        target_ws = manager.active_connections[manager.user_connections[target_user]]
-                        await target_ws.send_json({
-                            "type": "friend_removed",
-                            "removed_user": username
+                    #searching the user's messages (see /search_messages)
+                    elif data["type"] == "search":
+                        query = data.get("query")
+                        if not isinstance(query, str) or not isinstance(data.get("with", ""), (str, type(None))):
+                            raise BadEvent("search needs the text in query (and a username in with)")
+                        limit = event_int(data, "limit", SEARCH_PAGE_SIZE, 1, SEARCH_MAX_PAGE_SIZE)
+                        offset = event_int(data, "offset", 0, 0, SEARCH_MAX_OFFSET)
+                        page = await search_page(username, query, data.get("with"), limit, offset)
+                        manager.send(connection_id, {"type": "search_results", "query": query, **page})
+
+                    #the list of conversations, for the inbox screen
+                    elif data["type"] == "get_inbox":
+                        conversations = await db.get_inbox(username)
+                        manager.send(connection_id, {
+                            "type": "inbox",
+                            "conversations": conversations
                         })
 
+                    #typing indicators and read receipts are coalesced and never stored as events (see EphemeralEvents)
+                    elif data["type"] == "typing":
+                        ephemeral.typing(username, data.get("to"), event_id(data, "room_id") if data.get("room_id") is not None else None, bool(data.get("typing", True)))
 
-            elif data["type"] == "message":
-                recipient = data["recipient"]
-                message = data["message"]
-                
-                db.save_message(username, recipient, message)
-
-                if recipient in manager.user_connections:
-                    recipient_ws = manager.active_connections[manager.user_connections[recipient]]
-                    await recipient_ws.send_json({
-                        "type": "message",
-                        "from": username,
-                        "message": message
-                    })
-
-                    await websocket.send_json({
-                        "type": "message",
-                        "to": recipient,
-                        "message": message
-                    })
-
-            elif data["type"] == "get_friends":
-                friends = db.get_friends_list(username)
-                await websocket.send_json({
-                    "type": "friends_list",
-                    "friends": friends
-                })
-
-            elif data["type"] == "get_pending_requests":
-                pending = db.get_pending_requests(username)
-                await websocket.send_json({
-                    "type": "pending_requests",
-                    "requests": pending
-                }) 
-
-            #responding to a friend request
-            elif data["type"] == "friend_response":
-                #who sent the original request
-                requester = data["requester"]
-                #the response (accept/declined)
-                response = data["response"]  
-                #update the database
-                db.respond_to_friend_request(username, requester, response)
-                #if the requester is online
-                if requester in manager.user_connections:
-                    requester_ws = manager.active_connections[manager.user_connections[requester]]
-                    #send the notification to the requester
-                    await requester_ws.send_json({
-                        "type": "friend_response",
-                        "from": username,
-                        "response": response
-                    })
+                    elif data["type"] == "read":
+                        message_id = event_id(data, "message_id")
+                        if message_id < 1 or not isinstance(data.get("with"), str):
+                            raise BadEvent("read needs a username in with and a message_id")
+                        #whether the message is in the conversation is checked when the receipts are flushed, without a query per receipt
+                        ephemeral.read(username, data["with"], message_id)
+
+                    #the user opened a conversation, so it has no unread messages anymore
+                    elif data["type"] == "mark_read":
+                        await db.mark_read(username, data["with"])
+
+                    #---rooms---
+                    elif data["type"] == "create_room":
+                        room_id, members = await db.create_room(username, data["name"], data.get("members", []))
+                        if room_id is not None:
+                            manager.send_to_users(members, {
+                                "type": "room_created",
+                                "room_id": room_id,
+                                "name": data["name"],
+                                "members": members
+                            })
+
+                    elif data["type"] == "add_room_members":
+                        room_id = event_id(data, "room_id")
+                        room = await db.get_room(room_id)
+                        if room is not None and username in room["members"]:
+                            #taken before the write: whether room is the cached dict (and gets the new members too) depends on the cache
+                            members = list(room["members"])
+                            added = await db.add_room_members(room_id, data["members"])
+                            if added:
+                                #everyone in the room (old and new members) hears about it
+                                manager.send_to_users(members + [member for member in added if member not in members], {
+                                    "type": "room_members_added",
+                                    "room_id": room_id,
+                                    "name": room["name"],
+                                    "members": added
+                                })
+
+                    elif data["type"] == "leave_room":
+                        room_id = event_id(data, "room_id")
+                        if await db.leave_room(room_id, username):
+                            room = await db.get_room(room_id)
+                            manager.send_to_users([username, *(room["members"] if room else [])], {
+                                "type": "room_member_left",
+                                "room_id": room_id,
+                                "member": username
+                            })
+
+                    #a message to everyone in a room: saved once, encoded once per wire format, then queued for every online member
+                    elif data["type"] == "room_message":
+                        room_id = event_id(data, "room_id")
+                        room = await db.get_room(room_id)
+                        if room is None or username not in room["members"]:
+                            manager.send(connection_id, {"type": "error", "error": "not a member of this room", "room_id": room_id})
+                        else:
+                            members = list(room["members"])
+                            message_id = await db.save_room_message(room_id, username, data["message"], members, data.get("client_id"))
+                            ephemeral.message_sent(username, room_id=room_id)
+                            payload = {"type": "room_message", "room_id": room_id, "from": username, "message": data["message"]}
+                            if message_id is not None:
+                                payload["message_id"] = message_id
+                            manager.send_to_users(members, payload)
+
+                    elif data["type"] == "get_rooms":
+                        manager.send(connection_id, {
+                            "type": "rooms",
+                            "rooms": await db.get_user_rooms(username)
+                        })
+
+                    #responding to a friend request
+                    elif data["type"] == "friend_response":
+                        #who sent the original request
+                        requester = data["requester"]
+                        #the response (accept/declined)
+                        response = data["response"]  
+                        #update the database
+                        accepted = await db.respond_to_friend_request(username, requester, response) and response.lower() == 'accept'
+                        #if the requester is online
+                        if manager.is_online(requester):
+                            #send the notification to the requester
+                            manager.send_to_user(requester, {
+                                "type": "friend_response",
+                                "from": username,
+                                "response": response
+                            })
+                        #new friends can now see each other online
+                        if accepted:
+                            presence.friendship_changed(username, requester, True)
             
-            #handling normal messages
-            elif data["type"] == "message":
-                recipient = data["recipient"]
-                message = data["message"]
+                    #handling normal messages
+                    elif data["type"] == "message":
+                        recipient = data["recipient"]
+                        message = data["message"]
                 
-                #if the recipient is online
-                if recipient in manager.user_connections:
-                    #find connection_id of the user, use that connection_id to find the WebSocket connection to get a live connection
-                    recipient_ws = manager.active_connections[manager.user_connections[recipient]]
-                    #send a message in real-time
-                    await recipient_ws.send_json({
-                        "type": "message",
-                        "sender": username,
-                        "message": message,
-                        "timestamp": datetime.now().isoformat()
-                    })
+                        #if the recipient is online
+                        if manager.is_online(recipient):
+                            #queue it on the recipient's connection to send it in real-time
+                            manager.send_to_user(recipient, {
+                                "type": "message",
+                                "sender": username,
+                                "message": message,
+                                "timestamp": datetime.now().isoformat()
+                            })
+                except BadEvent as e:
+                    manager.send(connection_id, {"type": "error", "error": str(e), "event": data["type"]})
+
+                event_type = data["type"] if data["type"] in WS_EVENT_TYPES else "unknown"
+                ws_event_seconds.observe(time.perf_counter() - started, event_type)
     
     #if the user closes the tab or loses internet
     except WebSocketDisconnect:
+        pass
+    #runs however the handler ends (e.g. a frame that isn't valid JSON), so nobody is left online after their connection is gone
+    finally:
         #remove them from connection
+        #nothing is written to the database, the next presence snapshot will save that they went offline
         manager.disconnect(connection_id, username)
         
-        cursor = db.connection.cursor()
-        cursor.execute("SELECT password FROM users WHERE username=?", (username,))
-        result = cursor.fetchone()
-        password = result[0] if result else ""
-        
-        #set their online status to false
-        db.set_user_offline(username, password)
-        #update everyone's user list
-        await manager.broadcast_user_list()
+        #let their friends know they went offline
+        presence.user_disconnected(username)
 
 
 #---Run server---
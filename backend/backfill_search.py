@@ -0,0 +1,41 @@
+#one-off command that adds the messages saved before message search existed to the search index
+#run it from the backend folder with: python backfill_search.py
+#(set DATABASE_PATH first if the database is not user.db in this folder)
+#it indexes a chunk of messages per transaction and pauses in between, so it can run while the server is up
+#if it is stopped, running it again continues where it left off
+
+import argparse
+import asyncio
+import time
+
+from backend import db
+
+
+async def backfill(chunk_size: int, pause: float):
+    total = 0
+    start = time.perf_counter()
+    while True:
+        indexed, remaining = await db.backfill_search(chunk_size)
+        total += indexed
+        if indexed:
+            print(f"indexed {total} messages, {remaining} to go")
+        if remaining == 0:
+            break
+        #let the server's own writes in between chunks
+        await asyncio.sleep(pause)
+    print(f"done: {total} messages indexed in {time.perf_counter() - start:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the messages that are older than the search index")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="messages indexed per transaction")
+    parser.add_argument("--pause-ms", type=float, default=50.0, help="pause between chunks")
+    args = parser.parse_args()
+    try:
+        asyncio.run(backfill(args.chunk_size, args.pause_ms / 1000))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#benchmark for sending one event to many users with ConnectionManager.send_to_users (room messages, presence, ...)
+#it measures the path every fan-out in the server takes: the payload is encoded once and queued on each Outbox (see queue_for)
+#run it from the backend folder with: python bench_broadcast.py
+#no real sockets are opened: every "client" is a fake WebSocket that takes a little while to send, like a real network write would
+#the time measured is from starting the send until every client has received it (or was dropped for being too slow)
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+#use a throwaway database so the benchmark never touches user.db
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+from backend import ConnectionManager
+
+
+#pretends to be a starlette WebSocket
+class FakeWebSocket:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = 0
+        self.closed = False
+
+    async def send_text(self, text: str):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+
+    async def send_json(self, data: dict):
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+    async def close(self):
+        self.closed = True
+
+
+#the way the user list used to be sent: one send after the other, serializing the payload every time
+async def sequential_broadcast(manager: ConnectionManager):
+    online_users = list(manager.user_connections.keys())
+    for connection in manager.active_connections.values():
+        await connection.send_json({
+            "type": "user_list",
+            "users": online_users
+        })
+
+
+def make_manager(connections: int, latency: float, slow: int, slow_latency: float, timeout: float) -> ConnectionManager:
+    manager = ConnectionManager(send_timeout=timeout)
+    for i in range(connections):
+        #the first "slow" clients are stalled clients that take far longer than everyone else
+        manager.register(FakeWebSocket(slow_latency if i < slow else latency), f"user{i}")
+    return manager
+
+
+#queues the user list for every connected user, like a room message to a room with all of them in it
+async def concurrent_broadcast(manager: ConnectionManager):
+    online_users = list(manager.user_connections.keys())
+    manager.send_to_users(online_users, {
+        "type": "user_list",
+        "users": online_users
+    })
+
+
+async def measure(broadcast, manager: ConnectionManager) -> float:
+    websockets = list(manager.active_connections.values())
+    start = time.perf_counter()
+    await broadcast(manager)
+    #send_to_users only queues the frames, so wait until the writer tasks have sent them
+    while any(not websocket.sent and not websocket.closed for websocket in websockets):
+        await asyncio.sleep(0.001)
+    return time.perf_counter() - start
+
+
+#stops every writer task before the next round (and before the event loop shuts down)
+async def stop_writers(manager: ConnectionManager):
+    tasks = [outbox.task for outbox in manager.outboxes.values()]
+    for connection_id, username in list(manager.connection_users.items()):
+        manager.disconnect(connection_id, username)
+    await asyncio.gather(*tasks)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Measure how long sending one event to every connected user takes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="time a normal client takes for one send")
+    parser.add_argument("--slow", type=int, default=0, help="number of stalled clients")
+    parser.add_argument("--slow-latency-ms", type=float, default=3000.0)
+    parser.add_argument("--timeout", type=float, default=1.0, help="send timeout in seconds, stalled clients are dropped after it")
+    parser.add_argument("--skip-sequential", action="store_true", help="only measure the concurrent broadcast")
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    slow_latency = args.slow_latency_ms / 1000
+    print(f"{'connections':>12} {'sequential (s)':>15} {'concurrent (s)':>15} {'delivered':>10}")
+    for size in args.sizes:
+        sequential = "-"
+        if not args.skip_sequential:
+            manager = make_manager(size, latency, args.slow, slow_latency, args.timeout)
+            sequential = f"{await measure(sequential_broadcast, manager):.4f}"
+            await stop_writers(manager)
+
+        manager = make_manager(size, latency, args.slow, slow_latency, args.timeout)
+        websockets = list(manager.active_connections.values())
+        concurrent = await measure(concurrent_broadcast, manager)
+        delivered = sum(1 for websocket in websockets if websocket.sent)
+        await stop_writers(manager)
+        print(f"{size:>12} {sequential:>15} {concurrent:>15.4f} {delivered:>10}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
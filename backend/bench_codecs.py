@@ -0,0 +1,70 @@
+#micro-benchmark for the WebSocket wire formats
+#run it from the backend folder with: python bench_codecs.py
+#for every kind of event the server sends, it measures how long encoding and decoding take and how many bytes go on the wire
+
+import argparse
+import json
+import os
+import tempfile
+import timeit
+
+#use a throwaway database so the benchmark never touches user.db
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+from backend import BatchJsonCodec, MsgpackCodec, msgpack, orjson
+
+
+#the standard json module, the way WebSocket.send_json / receive_json use it
+class StdlibJsonCodec:
+    def encode(self, payload: dict) -> str:
+        return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+friends = [f"user{i}" for i in range(50)]
+
+#one example of every event the server sends today
+EVENTS = {
+    "user_list": {"type": "user_list", "users": friends},
+    "presence_delta": {"type": "presence_delta", "joined": friends[:3], "left": friends[3:5]},
+    "message (received)": {"type": "message", "from": "alice", "message": "Hey! Are we still on for tonight? " * 3},
+    "message (sent)": {"type": "message", "to": "bob", "message": "Hey! Are we still on for tonight? " * 3},
+    "friend_request_received": {"type": "friend_request_received", "from": "alice"},
+    "friend_response": {"type": "friend_response", "from": "bob", "response": "accept"},
+    "friend_removed": {"type": "friend_removed", "target": "bob"},
+    "friends_list": {"type": "friends_list", "friends": friends},
+    "pending_requests": {"type": "pending_requests", "requests": friends[:10]},
+    "resync": {"type": "resync"},
+}
+
+
+def measure(codec, payload: dict, number: int):
+    encoded = codec.encode(payload)
+    size = len(encoded.encode() if isinstance(encoded, str) else encoded)
+    encode = timeit.timeit(lambda: codec.encode(payload), number=number) / number * 1e6
+    decode = timeit.timeit(lambda: codec.decode(encoded), number=number) / number * 1e6
+    return encode, decode, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare encode/decode cost of the wire formats")
+    parser.add_argument("--number", type=int, default=20000, help="repetitions per measurement")
+    args = parser.parse_args()
+
+    codecs = {"json (stdlib)": StdlibJsonCodec()}
+    #BatchJsonCodec uses orjson when it is installed, otherwise it is the same as the stdlib column
+    codecs["chat.json" + (" (orjson)" if orjson is not None else " (stdlib)")] = BatchJsonCodec()
+    if msgpack is not None:
+        codecs["chat.msgpack"] = MsgpackCodec()
+
+    print(f"{'event':<24} {'codec':<20} {'encode (us)':>12} {'decode (us)':>12} {'bytes':>7}")
+    for name, payload in EVENTS.items():
+        for codec_name, codec in codecs.items():
+            encode, decode, size = measure(codec, payload, args.number)
+            print(f"{name:<24} {codec_name:<20} {encode:>12.2f} {decode:>12.2f} {size:>7}")
+
+
+if __name__ == "__main__":
+    main()
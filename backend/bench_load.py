@@ -0,0 +1,405 @@
+#load test for the whole server: real HTTP requests and real WebSockets against a real uvicorn process
+#run it from the backend folder with: python bench_load.py --output results.json
+#every simulated client signs up, logs in, becomes friends with one other client and connects to /ws/{username}, then the scenarios run:
+#  steady:    every client keeps chatting with its friend, we time each message from send to delivery
+#  reconnect: every client drops its connection and reconnects at the same moment (like after a deploy)
+#  history:   clients page back through long conversations with /get_messages
+#the results are written as JSON (with the git commit they were measured on), pass an older file to --compare to see what changed
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+import websockets
+
+from bench_login import percentile, post, request, start_server, stop_server
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+#one simulated user with one WebSocket
+class Client:
+    def __init__(self, port: int, username: str, subprotocol: str = None):
+        self.port = port
+        self.username = username
+        self.subprotocol = subprotocol
+        self.friend = None
+        self.ws = None
+        self.reader = None
+        #event type: futures waiting for the next event of that type
+        self.waiters = {}
+        #where the delivery latency (ms) of every message received is appended, None to ignore them
+        self.latencies = None
+
+    async def connect(self):
+        subprotocols = [self.subprotocol] if self.subprotocol else None
+        user_list = self.expect("user_list")
+        self.ws = await websockets.connect(f"ws://127.0.0.1:{self.port}/ws/{self.username}", subprotocols=subprotocols, max_size=None)
+        self.reader = asyncio.create_task(self.read())
+        #the server sends the list of online friends right after accepting the connection
+        await user_list
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+            await self.reader
+            self.ws = None
+
+    #a future that is resolved by the next event of this type
+    def expect(self, kind: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(kind, []).append(future)
+        return future
+
+    async def send(self, event: dict):
+        if self.subprotocol == "chat.msgpack":
+            await self.ws.send(msgpack.packb(event))
+        else:
+            await self.ws.send(json.dumps(event))
+
+    async def read(self):
+        try:
+            async for frame in self.ws:
+                events = msgpack.unpackb(frame) if isinstance(frame, bytes) else json.loads(frame)
+                #batching wire formats put several events in one frame
+                for event in events if isinstance(events, list) else [events]:
+                    self.handle(event)
+        except websockets.ConnectionClosed:
+            pass
+
+    def handle(self, event: dict):
+        kind = event.get("type")
+        if kind == "ping":
+            asyncio.create_task(self.send({"type": "pong"}))
+        #a message from the friend (the copy sent back to the sender has "to" instead of "from")
+        elif kind == "message" and "from" in event:
+            if self.latencies is not None:
+                self.latencies.append((time.perf_counter() - float(event["message"].split()[0])) * 1000)
+        for future in self.waiters.pop(kind, []):
+            if not future.done():
+                future.set_result(event)
+
+
+#runs coroutines with at most "limit" of them at once
+async def bounded(coroutines, limit: int):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+
+def latency_summary(values) -> dict:
+    if not values:
+        #NaN is not valid JSON
+        return {"count": 0, "p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 0.5),
+        "p95_ms": percentile(values, 0.95),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": max(values),
+    }
+
+
+#what the server process has used so far: CPU time and memory from /proc (Linux only), counters from /stats
+async def server_snapshot(port: int, pid: int) -> dict:
+    _, body = await request(port, "/stats")
+    snapshot = {"time": time.perf_counter(), "stats": json.loads(body), "cpu_seconds": None, "rss_mb": None, "peak_rss_mb": None}
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            #utime and stime, in clock ticks, come after the command name (which is in brackets)
+            fields = stat.read().rsplit(")", 1)[1].split()
+        snapshot["cpu_seconds"] = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    snapshot["rss_mb"] = int(line.split()[1]) / 1024
+                elif line.startswith("VmHWM:"):
+                    snapshot["peak_rss_mb"] = int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return snapshot
+
+
+#what a scenario cost the server, from the snapshots taken before and after it
+def server_usage(before: dict, after: dict) -> dict:
+    wall = after["time"] - before["time"]
+    usage = {
+        "wall_seconds": wall,
+        "commits": after["stats"]["commits"] - before["stats"]["commits"],
+        "messages_written": after["stats"]["messages_written"] - before["stats"]["messages_written"],
+        "message_batches": after["stats"]["message_batches"] - before["stats"]["message_batches"],
+        "dropped_frames": after["stats"]["dropped_frames"] - before["stats"]["dropped_frames"],
+        "rss_mb": after["rss_mb"],
+        "peak_rss_mb": after["peak_rss_mb"],
+        "cpu_seconds": None,
+        "cpu_percent": None,
+    }
+    if before["cpu_seconds"] is not None and after["cpu_seconds"] is not None:
+        usage["cpu_seconds"] = after["cpu_seconds"] - before["cpu_seconds"]
+        usage["cpu_percent"] = usage["cpu_seconds"] / wall * 100
+    return usage
+
+
+#waits until the server has saved every queued message
+async def wait_for_writes(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        _, body = await request(port, "/stats")
+        if json.loads(body)["message_queue_depth"] == 0:
+            return
+        await asyncio.sleep(0.05)
+
+
+#signs everyone up, logs them in, connects them and makes client 2k and 2k+1 friends
+async def setup(args, port: int):
+    clients = [Client(port, f"load{i}", args.subprotocol) for i in range(args.clients)]
+
+    async def join(client: Client):
+        if await post(port, "/signup", {"username": client.username, "password": "password"}) != 200:
+            raise RuntimeError(f"signup failed for {client.username}")
+        if await post(port, "/login", {"username": client.username, "password": "password"}) != 200:
+            raise RuntimeError(f"login failed for {client.username}")
+        await client.connect()
+
+    start = time.perf_counter()
+    await bounded((join(client) for client in clients), args.concurrency)
+
+    async def befriend(client: Client, friend: Client):
+        client.friend, friend.friend = friend, client
+        received = friend.expect("friend_request_received")
+        await client.send({"type": "friend_request", "recipient": friend.username})
+        await received
+        answered = client.expect("friend_response")
+        await friend.send({"type": "friend_response", "requester": client.username, "response": "accept"})
+        await answered
+
+    await bounded((befriend(clients[i], clients[i + 1]) for i in range(0, len(clients) - 1, 2)), args.concurrency)
+    return clients, {"clients": len(clients), "setup_seconds": time.perf_counter() - start}
+
+
+#every client sends its friend "rate" messages per second for "duration" seconds
+async def steady(args, port: int, clients) -> dict:
+    chatting = [client for client in clients if client.friend is not None]
+    latencies = []
+    for client in chatting:
+        client.latencies = latencies
+    sent = 0
+    interval = 1 / args.rate
+
+    async def chat(client: Client):
+        nonlocal sent
+        #spread the clients out so they don't all send at the same moment
+        await asyncio.sleep(random.random() * interval)
+        end = time.perf_counter() + args.duration
+        next_send = time.perf_counter()
+        while next_send < end:
+            await client.send({"type": "message", "recipient": client.friend.username, "message": f"{time.perf_counter()} steady chat"})
+            sent += 1
+            next_send += interval
+            await asyncio.sleep(max(0, next_send - time.perf_counter()))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(chat(client) for client in chatting))
+    sending = time.perf_counter() - start
+    #give the last messages a moment to arrive
+    deadline = time.perf_counter() + args.drain_seconds
+    while len(latencies) < sent and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    for client in chatting:
+        client.latencies = None
+    return {
+        "messages_sent": sent,
+        "messages_delivered": len(latencies),
+        "sent_per_second": sent / sending,
+        "delivered_per_second": len(latencies) / (time.perf_counter() - start),
+        "delivery_latency": latency_summary(latencies),
+    }
+
+
+#every client disconnects, then all of them reconnect at once
+async def reconnect(args, port: int, clients) -> dict:
+    await asyncio.gather(*(client.close() for client in clients))
+    latencies = []
+    failures = 0
+
+    async def rejoin(client: Client):
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(client.connect(), args.connect_timeout)
+            latencies.append((time.perf_counter() - start) * 1000)
+        except Exception:
+            failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(rejoin(client) for client in clients))
+    return {
+        "reconnected": len(latencies),
+        "failures": failures,
+        "storm_seconds": time.perf_counter() - start,
+        "connect_latency": latency_summary(latencies),
+    }
+
+
+#fills the conversations with history, then pages back through them from several readers at once
+async def history(args, port: int, clients) -> dict:
+    pairs = [(client, client.friend) for client in clients[0::2] if client.friend is not None]
+
+    async def fill(client: Client, friend: Client):
+        for i in range(args.history_messages):
+            await client.send({"type": "message", "recipient": friend.username, "message": f"{time.perf_counter()} history {i}"})
+
+    await asyncio.gather(*(fill(client, friend) for client, friend in pairs))
+    await wait_for_writes(port)
+
+    latencies = []
+    pages = 0
+
+    async def reader():
+        nonlocal pages
+        end = time.perf_counter() + args.history_seconds
+        while time.perf_counter() < end:
+            client, friend = random.choice(pairs)
+            before_id = None
+            #walk back through the whole conversation one page at a time
+            while time.perf_counter() < end:
+                query = {"user1": client.username, "user2": friend.username, "limit": args.page_size}
+                if before_id is not None:
+                    query["before_id"] = before_id
+                start = time.perf_counter()
+                status, body = await request(port, "/get_messages?" + urllib.parse.urlencode(query))
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status != 200:
+                    raise RuntimeError(f"/get_messages failed with {status}")
+                pages += 1
+                messages = json.loads(body)
+                if len(messages) < args.page_size:
+                    break
+                before_id = messages[0]["message_id"]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(reader() for _ in range(args.readers)))
+    return {
+        "pages_read": pages,
+        "pages_per_second": pages / (time.perf_counter() - start),
+        "page_latency": latency_summary(latencies),
+    }
+
+
+SCENARIOS = {"steady": steady, "reconnect": reconnect, "history": history}
+
+
+async def run(args, port: int, pid: int) -> dict:
+    clients, results = await setup(args, port)
+    scenarios = {}
+    for name in args.scenarios:
+        before = await server_snapshot(port, pid)
+        result = await SCENARIOS[name](args, port, clients)
+        result["server"] = server_usage(before, await server_snapshot(port, pid))
+        scenarios[name] = result
+        print_scenario(name, result)
+    await asyncio.gather(*(client.close() for client in clients))
+    results["scenarios"] = scenarios
+    return results
+
+
+def print_scenario(name: str, result: dict):
+    lines = [f"== {name}"]
+    for key, value in result.items():
+        if isinstance(value, dict):
+            value = ", ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in value.items())
+        elif isinstance(value, float):
+            value = f"{value:.2f}"
+        lines.append(f"  {key}: {value}")
+    print("\n".join(lines), file=sys.stderr)
+
+
+#the numbers in a result file, as {"steady.delivery_latency.p99_ms": 12.3, ...}
+def flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and value is not None:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(old: dict, new: dict):
+    print(f"compared with {old.get('commit', '?')}:", file=sys.stderr)
+    old_values, new_values = flatten(old["scenarios"]), flatten(new["scenarios"])
+    for key, value in new_values.items():
+        if key in old_values and old_values[key]:
+            change = (value - old_values[key]) / abs(old_values[key]) * 100
+            print(f"  {key:<45} {old_values[key]:>12.2f} -> {value:>12.2f} ({change:+.1f}%)", file=sys.stderr)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive many simulated clients against a local server and measure it")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--subprotocol", choices=["chat.json", "chat.msgpack"], default=None, help="wire format (default: plain JSON)")
+    parser.add_argument("--concurrency", type=int, default=50, help="signups/logins/friend requests in flight during setup")
+    parser.add_argument("--rate", type=float, default=1.0, help="steady: messages per second per client")
+    parser.add_argument("--duration", type=float, default=10.0, help="steady: seconds of chatting")
+    parser.add_argument("--drain-seconds", type=float, default=5.0, help="steady: how long to wait for the last messages")
+    parser.add_argument("--connect-timeout", type=float, default=30.0, help="reconnect: seconds before a reconnect counts as failed")
+    parser.add_argument("--history-messages", type=int, default=200, help="history: messages added to every conversation first")
+    parser.add_argument("--history-seconds", type=float, default=10.0)
+    parser.add_argument("--readers", type=int, default=20, help="history: concurrent readers")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--password-cost", type=int, default=2 ** 10,
+                        help="PASSWORD_SCRYPT_N for the server, kept low so setup is quick (bench_login.py measures logins)")
+    parser.add_argument("--output", help="write the results here instead of stdout")
+    parser.add_argument("--compare", help="an earlier result file to compare with")
+    args = parser.parse_args()
+    if args.subprotocol == "chat.msgpack" and msgpack is None:
+        parser.error("chat.msgpack needs the msgpack package")
+
+    server, port = start_server({"PASSWORD_SCRYPT_N": str(args.password_cost)})
+    try:
+        results = asyncio.run(run(args, port, server.pid))
+    finally:
+        stop_server(server)
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "settings": vars(args),
+        **results,
+    }
+    document = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(document + "\n")
+    else:
+        print(document)
+    if args.compare:
+        with open(args.compare) as old:
+            compare(json.load(old), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#benchmark for logins while people are chatting
+#run it from the backend folder with: python bench_login.py
+#it starts a real server (uvicorn, throwaway database), signs up some users, then keeps a few WebSocket clients
+#doing ping/pong round trips while a burst of logins runs
+#it reports login throughput and how much the round trips of the WebSocket clients suffer during the burst
+#compare with: python bench_login.py --hash-workers 0   (hashing on the event loop, the way it must never be done)
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+
+#sends one HTTP request and returns (status code, response body)
+#a JSON body is sent as a POST, no body as a GET
+async def request(port: int, path: str, body: dict = None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    data = json.dumps(body).encode() if body is not None else b""
+    method = "POST" if body is not None else "GET"
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+    )
+    await writer.drain()
+    head = (await reader.readuntil(b"\r\n\r\n")).decode()
+    length = 0
+    for line in head.split("\r\n")[1:]:
+        name, _, value = line.partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    response = await reader.readexactly(length)
+    writer.close()
+    return int(head.split()[1]), response
+
+
+#sends one JSON POST request and returns the status code
+async def post(port: int, path: str, body: dict) -> int:
+    status, _ = await request(port, path, body)
+    return status
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(port: int, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+#starts a real server in its own process on a free port, with a throwaway database so the benchmark never touches user.db
+#settings are extra environment variables for the server (see the Settings in backend.py)
+def start_server(settings: dict):
+    port = free_port()
+    env = dict(os.environ)
+    env["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    env.update(settings)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend:app", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=subprocess.DEVNULL
+    )
+    try:
+        asyncio.run(wait_for_server(port))
+    except Exception:
+        stop_server(server)
+        raise
+    return server, port
+
+
+def stop_server(server: subprocess.Popen):
+    server.terminate()
+    server.wait()
+
+
+#one client sending "ping" events and timing how long the "pong" takes
+#round trips are stored in samples[phase], where phase is whatever state["phase"] says at the time
+async def pinger(port: int, username: str, state: dict, samples: dict, interval: float):
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws/{username}") as ws:
+        while state["phase"] != "done":
+            phase = state["phase"]
+            start = time.perf_counter()
+            await ws.send(json.dumps({"type": "ping"}))
+            while json.loads(await ws.recv())["type"] != "pong":
+                pass
+            samples.setdefault(phase, []).append((time.perf_counter() - start) * 1000)
+            await asyncio.sleep(interval)
+
+
+async def login_burst(port: int, usernames, logins: int, concurrency: int):
+    latencies = []
+    next_login = iter(range(logins))
+
+    async def worker():
+        for i in next_login:
+            start = time.perf_counter()
+            status = await post(port, "/login", {"username": usernames[i % len(usernames)], "password": "password"})
+            if status != 200:
+                raise RuntimeError(f"login failed with {status}")
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start, latencies
+
+
+async def run(args, port: int):
+    usernames = [f"user{i}" for i in range(args.users)]
+    for username in usernames:
+        await post(port, "/signup", {"username": username, "password": "password"})
+
+    state = {"phase": "idle"}
+    samples = {}
+    pingers = [asyncio.create_task(pinger(port, f"chatter{i}", state, samples, args.ping_interval_ms / 1000)) for i in range(args.chatters)]
+    await asyncio.sleep(args.idle_seconds)
+    state["phase"] = "burst"
+    elapsed, latencies = await login_burst(port, usernames, args.logins, args.concurrency)
+    state["phase"] = "done"
+    await asyncio.gather(*pingers)
+
+    print(f"logins: {args.logins} in {elapsed:.2f} s = {args.logins / elapsed:.1f}/s"
+          f"  (login p50 {percentile(latencies, 0.5):.1f} ms, p99 {percentile(latencies, 0.99):.1f} ms)")
+    print(f"{'ws round trip':<16} {'samples':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+    for phase in ("idle", "burst"):
+        values = samples.get(phase, [])
+        print(f"{phase:<16} {len(values):>8} {percentile(values, 0.5):>9.2f} {percentile(values, 0.95):>9.2f}"
+              f" {percentile(values, 0.99):>9.2f} {max(values, default=float('nan')):>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure login throughput and WebSocket latency during a login burst")
+    parser.add_argument("--users", type=int, default=50, help="users signed up before the burst")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20, help="logins in flight at once")
+    parser.add_argument("--chatters", type=int, default=5, help="WebSocket clients measuring round trips")
+    parser.add_argument("--ping-interval-ms", type=float, default=10.0)
+    parser.add_argument("--idle-seconds", type=float, default=2.0, help="how long to measure round trips before the burst")
+    parser.add_argument("--hash-workers", type=int, default=None, help="PASSWORD_HASH_WORKERS for the server")
+    args = parser.parse_args()
+
+    settings = {}
+    if args.hash_workers is not None:
+        settings["PASSWORD_HASH_WORKERS"] = str(args.hash_workers)
+    server, port = start_server(settings)
+    try:
+        asyncio.run(run(args, port))
+    finally:
+        stop_server(server)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#bulk export and import of the whole database (users, friendships, rooms and every message) as NDJSON, see Export/Import in backend.py
+#run it from the backend folder with (set DATABASE_PATH first if the database is not user.db in this folder):
+#  python transfer.py export backup.ndjson.gz                   one file, gzip-compressed because of the .gz
+#  python transfer.py export backup.ndjson.gz --split 1000000   backup-00000.ndjson.gz, backup-00001.ndjson.gz, ... 1000000 records each
+#  python transfer.py import backup-*.ndjson.gz                 into an empty database, with the server stopped
+#the export can run while the server is up, it reads one consistent snapshot
+#if an import is stopped, running it again with the same files continues from its checkpoint
+#if it stopped before its first checkpoint, run it again with --resume: it starts over, rows already imported are skipped
+
+import argparse
+import gzip
+import itertools
+import json
+import os
+import time
+
+from backend import (
+    db, open_export_connection, export_records, export_chunks, import_row, import_batch, drop_indexes, finish_import
+)
+
+
+def open_file(path: str, mode: str):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+#backup.ndjson.gz -> backup-00003.ndjson.gz
+def part_path(path: str, number: int) -> str:
+    name, dot, extensions = os.path.basename(path).partition(".")
+    return os.path.join(os.path.dirname(path), f"{name}-{number:05d}{dot}{extensions}")
+
+
+def export(path: str, split: int):
+    start = time.perf_counter()
+    count = 0
+
+    def counting(records):
+        nonlocal count
+        for record in records:
+            count += 1
+            yield record
+
+    compress = path.endswith(".gz")
+    connection = open_export_connection(db.pool.path, db.pool.archive_path)
+    try:
+        records = counting(export_records(connection))
+        if not split:
+            write_part(path, records, compress)
+        else:
+            for number in itertools.count():
+                #stop before opening a file that would stay empty
+                first = next(records, None)
+                if first is None:
+                    break
+                write_part(part_path(path, number), itertools.chain([first], itertools.islice(records, split - 1)), compress)
+    finally:
+        connection.close()
+    print(f"exported {count} records in {time.perf_counter() - start:.1f} s")
+
+
+def write_part(path: str, records, compress: bool):
+    #the chunks come out already compressed, so the file is opened as a plain file
+    with open(path, "wb") as output:
+        for chunk in export_chunks(records, compress):
+            output.write(chunk)
+    print(f"wrote {path}")
+
+
+#the import runs on the writer connection of the pool, in big transactions
+def fast_writes(connection):
+    #every commit is flushed to disk before the checkpoint that points past it is written, so a crash never skips rows
+    #(with batches this big that is one flush per batch, which costs next to nothing)
+    connection.execute("PRAGMA synchronous=FULL")
+    #a bigger page cache (in KiB) makes building the indexes at the end much faster
+    connection.execute("PRAGMA cache_size=-262144")
+
+
+def is_empty(connection) -> bool:
+    return connection.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    #written next to the final file first, so a crash never leaves half a checkpoint
+    with open(path + ".tmp", "w") as output:
+        json.dump(checkpoint, output)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def import_files(paths, batch_size: int, checkpoint_path: str, resume: bool = False):
+    start = time.perf_counter()
+    checkpoint = {"files": paths, "file": 0, "line": 0}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as input_file:
+            checkpoint = json.load(input_file)
+        if checkpoint["files"] != paths:
+            raise SystemExit(f"{checkpoint_path} belongs to an import of other files: {checkpoint['files']}")
+        print(f"continuing from {paths[checkpoint['file']]}, line {checkpoint['line']}")
+    elif resume:
+        #rows are inserted with INSERT OR IGNORE, so the ones that made it in last time are skipped
+        print("no checkpoint, importing every file again on top of what is there")
+    elif not db.pool.write_sync(is_empty):
+        raise SystemExit("the database is not empty, import into a new DATABASE_PATH (or pass --resume to finish an import of these files)")
+
+    db.pool.write_sync(fast_writes)
+    db.pool.write_sync(drop_indexes)
+    imported = 0
+    for index in range(checkpoint["file"], len(paths)):
+        skip = checkpoint["line"] if index == checkpoint["file"] else 0
+        with open_file(paths[index], "rb") as input_file:
+            batch = {}
+            size = 0
+            for line_number, line in enumerate(input_file, 1):
+                if line_number <= skip or not line.strip():
+                    continue
+                row = import_row(line)
+                if row is None:
+                    continue
+                batch.setdefault(row[0], []).append(row[1])
+                size += 1
+                if size >= batch_size:
+                    db.pool.write_sync(import_batch, batch)
+                    imported += size
+                    save_checkpoint(checkpoint_path, {"files": paths, "file": index, "line": line_number})
+                    print(f"{imported} records imported ({imported / (time.perf_counter() - start):.0f}/s)")
+                    batch = {}
+                    size = 0
+            db.pool.write_sync(import_batch, batch)
+            imported += size
+        save_checkpoint(checkpoint_path, {"files": paths, "file": index + 1, "line": 0})
+
+    print("rebuilding the indexes and the search index")
+    db.pool.write_sync(finish_import)
+    db.pool.write_sync(db.create_tables)
+    os.remove(checkpoint_path)
+    print(f"imported {imported} records in {time.perf_counter() - start:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import the whole database as NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write the database to a file (.gz to compress it)")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--split", type=int, default=0, help="records per file, 0 writes a single file")
+    import_parser = commands.add_parser("import", help="read files written by export into an empty database")
+    import_parser.add_argument("paths", nargs="+")
+    import_parser.add_argument("--batch-size", type=int, default=100000, help="records per transaction")
+    import_parser.add_argument("--checkpoint", default=None, help="where the progress is kept (default: next to the database)")
+    import_parser.add_argument("--resume", action="store_true", help="allow a database that isn't empty, to finish an import that stopped before its first checkpoint")
+    args = parser.parse_args()
+    try:
+        if args.command == "export":
+            export(args.path, args.split)
+        else:
+            import_files(args.paths, args.batch_size, args.checkpoint or db.pool.path + ".import-checkpoint", args.resume)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
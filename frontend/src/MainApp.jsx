@@ -1,12 +1,17 @@
 import React, { useState, useEffect, useRef } from 'react';
 import FriendRequest from './FriendRequest';
 
+//how many messages /get_messages returns at a time, older ones are loaded a page at a time with before_id
+const PAGE_SIZE = 50;
+
 function MainApp({username}){
     const [onlineUsers, setOnlineUsers] = useState([]);
     const [messages, setMessages] = useState([]);
     const [newMessage, setNewMessage] = useState("");
     const [targetUser, setTargetUser] = useState("");
     const [showFriendsPanel, setShowFriendsPanel] = useState(false);
+    //true once the oldest message of the conversation has been loaded
+    const [reachedStart, setReachedStart] = useState(false);
 
     //keeps the WebSocket alive without re-creating it on every render
     const socketRef = useRef(null); 
@@ -51,11 +56,24 @@ function MainApp({username}){
             const data = JSON.parse(event.data);
             console.log("Parsed data:", data);
             
+            //the server checking that we are still here
+            if (data.type === "ping") {
+              ws.send(JSON.stringify({ type: "pong" }));
+            }
+
             //show the list of online users
-            if (data.type === "user_list") {
+            else if (data.type === "user_list") {
               setOnlineUsers(data.users);
             }
 
+            //friends who came online or went offline since the last update
+            else if (data.type === "presence_delta") {
+              setOnlineUsers(users => [
+                ...users.filter(user => !data.joined.includes(user) && !data.left.includes(user)),
+                ...data.joined
+              ]);
+            }
+
             else if(data.type === "message"){
                 setMessages(m => [...m, {
                     sender: data.sender,
@@ -88,13 +106,20 @@ function MainApp({username}){
         };
       }, [username]);
 
-        //keeps only messages that match a certain condition
-        const conversationMessages = messages.filter(msg => //msg is each message object
+        //true for messages between the user and the friend they are chatting with
+        const inConversation = msg => //msg is each message object
         //message sent by friend to the user
         (msg.sender === targetUser && msg.recipient === username) ||
         //message sent by user to friend
-        (msg.sender === username && msg.recipient === targetUser)
-        );
+        (msg.sender === username && msg.recipient === targetUser);
+
+        //keeps only messages that match a certain condition
+        const conversationMessages = messages.filter(inConversation);
+
+      //a new conversation starts again from its newest page
+      useEffect(() => {
+        setReachedStart(false);
+      }, [targetUser]);
 
       //load chat history
       useEffect(() => {
@@ -102,12 +127,17 @@ function MainApp({username}){
             if (!targetUser) return;
             
             try {
-                //asks the backend to get all messages between two users
-                const response = await fetch(`https://messaging-application-c9s5.onrender.com/get_messages?user1=${username}&user2=${targetUser}`);
+                //asks the backend for the newest page of messages between two users
+                const response = await fetch(`https://messaging-application-c9s5.onrender.com/get_messages?user1=${username}&user2=${targetUser}&limit=${PAGE_SIZE}`);
                 
                 if (response.ok) {
                     const data = await response.json();
-                    setMessages(data);
+                    if (data.length < PAGE_SIZE) {
+                        setReachedStart(true);
+                    }
+                    //keeps the older pages already loaded for this conversation in front of the newest one
+                    const oldest = data.length ? data[0].message_id : Infinity;
+                    setMessages(m => [...m.filter(msg => inConversation(msg) && msg.message_id < oldest), ...data]);
                 }
             } catch (error) {
                 console.error("Error loading messages:", error);
@@ -117,6 +147,27 @@ function MainApp({username}){
         loadConversation();
     }, [targetUser, username, conversationMessages]);
 
+    //loads the page of messages just before the oldest one shown
+    async function loadOlderMessages(){
+        const oldest = conversationMessages.find(msg => msg.message_id !== undefined);
+        if (!oldest) return;
+
+        try {
+            const response = await fetch(`https://messaging-application-c9s5.onrender.com/get_messages?user1=${username}&user2=${targetUser}&limit=${PAGE_SIZE}&before_id=${oldest.message_id}`);
+
+            if (response.ok) {
+                const data = await response.json();
+                if (data.length < PAGE_SIZE) {
+                    setReachedStart(true);
+                }
+                //skips messages that are already shown (e.g. when the button is clicked twice)
+                setMessages(m => [...data.filter(msg => !m.some(shown => shown.message_id === msg.message_id)), ...m]);
+            }
+        } catch (error) {
+            console.error("Error loading older messages:", error);
+        }
+    }
+
     
 
     return(
@@ -141,6 +192,11 @@ function MainApp({username}){
 
                     {/*Chat Box*/}
                     <div className="chat-box" style={{transition: "all 0.5s"}}>
+
+                        {/*Load Older Messages Button*/}
+                        {targetUser && !reachedStart && conversationMessages.length > 0 && (
+                            <button className="loadOlderBtn" onClick={loadOlderMessages}>LOAD OLDER MESSAGES</button>
+                        )}
                         
                         {conversationMessages.map((msg, index) => ( //loops through every message, and creates a JSX block to display for each message
                             <div className="message-content" key={index}>